@@ -4,7 +4,7 @@ import sys
 import logging
 import dotenv
 
-CONFIG_FILE = '.env'
+CONFIG_FILE = os.environ.get('SMRTLINK_SHARE_CONFIG', '.env')
 if 'pytest' in sys.modules:
     CONFIG_FILE = 'test/.env'
 
@@ -12,6 +12,8 @@ if not os.path.exists(CONFIG_FILE):
     raise ImportError(f'Config file {CONFIG_FILE} not found.')
 
 dotenv.load_dotenv(CONFIG_FILE)
+# processes started by the app (see app.xml) import it anew, so must read the same file
+os.environ['SMRTLINK_SHARE_CONFIG'] = os.path.abspath(CONFIG_FILE)
     
 try:
     GLOBUS_CLIENT_ID = os.environ.get('GLOBUS_CLIENT_ID')
@@ -31,6 +33,31 @@ except KeyError as e:
 
 APP_PORT = 9093
 
+# optional settings
+SMRTLINK_POOL_SIZE = int(os.environ.get('SMRTLINK_POOL_SIZE', 10)) # max. kept-alive connections to SMRT Link
+SMRTLINK_RETRIES = int(os.environ.get('SMRTLINK_RETRIES', 3)) # retries after failing to connect to SMRT Link
+SMRTLINK_TIMEOUT = float(os.environ.get('SMRTLINK_TIMEOUT', 60)) # seconds to wait for SMRT Link to respond
+SMRTLINK_CACHE_SIZE = int(os.environ.get('SMRTLINK_CACHE_SIZE', 10000)) # max. unchanging SMRT Link responses (e.g. job datastores) kept in memory (0 to disable)
+SMRTLINK_CACHE_PATH = os.environ.get('SMRTLINK_CACHE_PATH') or None # file in which cached SMRT Link responses are kept across restarts
+WORKER_COUNT = int(os.environ.get('WORKER_COUNT', 4)) # max. notifications handled at once
+UPDATE_WINDOW = float(os.environ.get('UPDATE_WINDOW', 1)) # seconds during which updates to a project are handled as one
+GLOBUS_MAX_WORKERS = int(os.environ.get('GLOBUS_MAX_WORKERS', 8)) # max. concurrent Globus API calls
+PROJECT_DIRECTORIES = os.environ.get('PROJECT_DIRECTORIES', '').lower() in ('1', 'true', 'yes') # stage datasets in a directory per project and share the project directory
+ACL_RECONCILE_HOURS = float(os.environ.get('ACL_RECONCILE_HOURS', 24)) # hours between reconciling Globus permissions with app state (0 to disable)
+PERMISSION_SWEEP_HOURS = float(os.environ.get('PERMISSION_SWEEP_HOURS', 1)) # hours between removing expired permissions and renewing expiring ones (0 to disable)
+PERMISSION_RENEWAL_DAYS = float(os.environ.get('PERMISSION_RENEWAL_DAYS', 7)) # renew permissions of project members this many days before they expire
+STAGING_WORKERS = int(os.environ.get('STAGING_WORKERS', 16)) # max. files linked at once when staging
+JOB_SYNC_PAGE_SIZE = int(os.environ.get('JOB_SYNC_PAGE_SIZE', 50)) # analysis jobs handled between updates of the sync cursor
+JOB_SYNC_MAX_PAGES = int(os.environ.get('JOB_SYNC_MAX_PAGES', 10)) # pages of jobs handled before yielding to other events
+JOB_RETRY_LIMIT = int(os.environ.get('JOB_RETRY_LIMIT', 10)) # attempts to handle an analysis job before giving up
+PROJECT_RETRY_LIMIT = int(os.environ.get('PROJECT_RETRY_LIMIT', 10)) # attempts to handle a new project before giving up
+JOB_POLL_MIN_INTERVAL = float(os.environ.get('JOB_POLL_MIN_INTERVAL', 30)) # seconds between checks of a pending analysis job whose state just changed
+JOB_POLL_MAX_INTERVAL = float(os.environ.get('JOB_POLL_MAX_INTERVAL', 600)) # max. seconds between checks of a pending analysis job
+DB_BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', 30)) # seconds to wait for another thread's database write to finish
+XML_CACHE_SIZE = int(os.environ.get('XML_CACHE_SIZE', 1024)) # max. parsed dataset XML files kept in memory
+XML_PARSER = os.environ.get('XML_PARSER', 'stream').lower() # 'stream', or 'pbcore' to parse dataset XML with pbcore
+CHILD_PARSE_WORKERS = int(os.environ.get('CHILD_PARSE_WORKERS', 4)) # max. processes parsing the XML of a parent's children (1 to disable)
+
 logger = logging.getLogger('smrtlink-share')
 logger.setLevel(logging.INFO)
 log_formatter = logging.Formatter(
@@ -42,6 +69,7 @@ handler.setLevel(logging.INFO)
 logger.addHandler(handler)
 
 class BaseDataset(abc.ABC):
+    __slots__ = () # allow subclasses without an instance __dict__
 
     @property
     @abc.abstractmethod
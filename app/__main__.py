@@ -9,27 +9,29 @@ def abort(message):
     print(f"Aborting app: {message}")
     exit(1)
 
-# check that the app is running as the correct user and group
-if app.APP_USER != getpass.getuser():
-    abort(f"App must be run as user '{app.APP_USER}' specified in .env file.")
-try:
-    gid = grp.getgrnam(app.GROUP_NAME).gr_gid
-except KeyError:
-    abort(f"Group '{app.GROUP_NAME}' not found")
-if gid != os.getgid():
-    abort(f"App must be run as group '{app.GROUP_NAME}'")
+# processes which parse XML (see app.xml) import this module too, but must not run the app
+if __name__ == '__main__':
+    # check that the app is running as the correct user and group
+    if app.APP_USER != getpass.getuser():
+        abort(f"App must be run as user '{app.APP_USER}' specified in .env file.")
+    try:
+        gid = grp.getgrnam(app.GROUP_NAME).gr_gid
+    except KeyError:
+        abort(f"Group '{app.GROUP_NAME}' not found")
+    if gid != os.getgid():
+        abort(f"App must be run as group '{app.GROUP_NAME}'")
 
-# check that all modules initialize properly
-import app.smrtlink
-import app.globus
-import app.filesystem # import to create staging root directory
-if app.smrtlink.CLIENT is None:
-    abort('SMRT Link client failed to initialize (check log for error message).')
-if app.globus.TRANSFER_CLIENT is None:
-    abort('Globus transfer client failed to initialize (check log for error message).')
-if not os.path.exists(app.STAGING_ROOT): # otherwise, directory exists and we assume it has proper permissions as set in app/filesystem.py
-    abort(f"Staging root directory '{app.STAGING_ROOT}' specified in .env file does not exist.")
+    # check that all modules initialize properly
+    import app.smrtlink
+    import app.globus
+    import app.filesystem # import to create staging root directory
+    if app.smrtlink.CLIENT is None:
+        abort('SMRT Link client failed to initialize (check log for error message).')
+    if app.globus.TRANSFER_CLIENT is None:
+        abort('Globus transfer client failed to initialize (check log for error message).')
+    if not os.path.exists(app.STAGING_ROOT): # otherwise, directory exists and we assume it has proper permissions as set in app/filesystem.py
+        abort(f"Staging root directory '{app.STAGING_ROOT}' specified in .env file does not exist.")
 
-# initialize and run the app
-app = app.server.App(('localhost', app.APP_PORT))
-app.run()
\ No newline at end of file
+    # initialize and run the app
+    server = app.server.App(('localhost', app.APP_PORT))
+    server.run()
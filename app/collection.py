@@ -1,12 +1,26 @@
+import functools
+import typing
 import abc
 import os
 
 import app.xml
+import app
+
+def project_dir(project_id: int) -> str:
+    '''Return the path of the directory in which a project's datasets are
+    staged when `app.PROJECT_DIRECTORIES` is set.'''
+    return f'Project {project_id}'
+
+def _required(value, description: str):
+    if value is None:
+        raise ValueError(f'Dataset XML has no {description}')
+    return value
 
 class FileCollection(abc.ABC):
     @property
     @abc.abstractmethod
-    def files(self) -> list[str]:
+    def files(self) -> tuple[str, ...]:
+        '''Subclasses compute this once, on first access.'''
         pass
 
     @property
@@ -37,6 +51,14 @@ class PendingAnalysis:
         self._parent_dir = parent_dir
         self._job = job
     
+    @property
+    def job(self) -> dict:
+        return self._job
+
+    @property
+    def parent_dir(self) -> str:
+        return self._parent_dir
+
     def complete(self, files):
         '''Return a CompletedAnalysis object for this analysis.'''
         return CompletedAnalysis(self._parent_dir, self._job, files)
@@ -56,9 +78,9 @@ class CompletedAnalysis(FileCollection):
     def _dir_name(self):
         return f'Analysis {self._id}: {self._name}'
     
-    @property
+    @functools.cached_property
     def files(self):
-        return self._files
+        return tuple(self._files)
 
 class SupplementalResources(FileCollection):
     def __init__(self, parent_dir, files):
@@ -73,9 +95,43 @@ class SupplementalResources(FileCollection):
     def _dir_name(self):
         return 'Supplemental Run Data'
 
-    @property
+    @functools.cached_property
     def files(self):
-        return self._files
+        return tuple(self._files)
+
+class DatasetRecord(app.BaseDataset):
+    '''
+    What remains of a Dataset once it has been handled: just the fields
+    needed to grant access to it and to stage its analyses. Records are
+    immutable and much smaller than a Dataset, which also holds the parsed
+    XML and, for a parent, all of its children.
+    '''
+    __slots__ = ('uuid', 'name', 'movie_id', 'barcode', 'dir_path', 'files')
+
+    def __init__(self, uuid: str, name: str, movie_id: str, barcode: typing.Union[str, None],
+                 dir_path: str, files: tuple[str, ...]):
+        for field, value in zip(self.__slots__, (uuid, name, movie_id, barcode, dir_path, tuple(files))):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def _fields(self) -> tuple:
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not DatasetRecord:
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        return f'DatasetRecord(uuid={self.uuid!r}, dir_path={self.dir_path!r})'
 
 class Dataset(FileCollection, app.BaseDataset):
 
@@ -87,13 +143,18 @@ class Dataset(FileCollection, app.BaseDataset):
         else: 
             return super(Dataset, cls).__new__(cls)
 
-    def __init__(self, **kwargs):
+    def __init__(self, info: app.xml.DatasetInfo = None, **kwargs):
+        '''`info`: the dataset's parsed XML, if already loaded.'''
         self._uuid = kwargs['uuid']
-        self._xml = app.xml.DatasetXml(kwargs['path'])
+        self._info = info if info is not None else app.xml.load(kwargs['path'])
         self._name = kwargs['name']
         if 'parentUuid' in kwargs:
-            self._name = app.xml.get_sample_name(self._xml)
-        self._movie_id = app.xml.get_movie_id(self._xml)
+            self._name = _required(self._info.sample_name, 'sample name')
+        self._movie_id = _required(self._info.movie_id, 'movie ID')
+        self._barcode = self._info.barcode
+        self._project_dir = super()._prefix # empty string
+        if app.PROJECT_DIRECTORIES and 'projectId' in kwargs:
+            self._project_dir = project_dir(kwargs['projectId'])
     
     @property
     def uuid(self):
@@ -101,15 +162,19 @@ class Dataset(FileCollection, app.BaseDataset):
     
     @property
     def _prefix(self):
-        return super()._prefix # empty string
+        return self._project_dir
 
     @property
     def _dir_name(self):
         return f'Movie {self._movie_id} - {self._name}'
     
-    @property
+    @functools.cached_property
     def files(self):
-        return app.xml.resources_to_file_paths(self._xml.externalResources)
+        return tuple(self._info.files)
+
+    def record(self) -> DatasetRecord:
+        return DatasetRecord(self._uuid, self._name, self._movie_id, self._barcode,
+                             self.dir_path, self.files)
 
     def __str__(self):
         return str(self._name)
@@ -122,18 +187,21 @@ class Parent(Dataset):
     '''
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self._name = app.xml.get_well_sample_name(self._xml)
+        self._name = _required(self._info.well_sample_name, 'well sample name')
+        self._barcode = None # each child has its own barcode
         self._num_children = kwargs['numChildren']
-        child_dataset_dicts = app.xml.get_child_dataset_dicts(self._xml)
+        child_paths = self._info.child_paths
         self.child_datasets = []
-        for child_dict in child_dataset_dicts:
+        for path, child in zip(child_paths, app.xml.load_many(child_paths)): # children are parsed in parallel
             try:
-                dataset = Child(self._dir_name, **child_dict) 
+                if isinstance(child, Exception):
+                    raise child
+                dataset = Child(self.dir_path, info=child, name=child.name, uuid=child.uuid, path=path)
             except Exception as e:
-                app.logger.error(f"Cannot handle SMRT Link dataset {child_dict['id']}: {e}.")
+                app.logger.error(f"Cannot handle SMRT Link dataset {path}: {e}.")
                 continue
             self.child_datasets.append(dataset)
-        self.child_datasets.append(SupplementalResources(self._dir_name, self.files))
+        self.child_datasets.append(SupplementalResources(self.dir_path, self._info.supplemental_files))
 
     @property
     def _prefix(self):
@@ -143,9 +211,9 @@ class Parent(Dataset):
     def _dir_name(self):
         return f'{super()._dir_name} ({self._num_children} barcoded samples)'
     
-    @property
+    @functools.cached_property
     def files(self):
-        return [] # Parent datasets have no files of their own
+        return () # Parent datasets have no files of their own
     
 class Child(Dataset):
     '''
@@ -157,8 +225,7 @@ class Child(Dataset):
     '''
     def __init__(self, parent_dir, **kwargs):
         super().__init__(**kwargs)
-        self._barcode = app.xml.get_barcode(self._xml)
-        self._name = app.xml.get_sample_name(self._xml) # replace DataSet name with BioSample name
+        self._name = _required(self._info.sample_name, 'sample name') # replace DataSet name with BioSample name
         self._parent_dir = parent_dir
     
     @property
@@ -1,3 +1,5 @@
+import concurrent.futures
+import typing
 import pwd
 import os
 
@@ -13,6 +15,14 @@ try:
 except Exception as e:
     print(f"Failed to create staging root directory: {e}")
 
+try:
+    APP_UID = pwd.getpwnam(app.APP_USER).pw_uid # look up once, rather than per file
+except KeyError:
+    app.logger.error(f"User '{app.APP_USER}' not found; staged files will not be removed.")
+    APP_UID = None
+
+PARALLEL_UNLINK_THRESHOLD = 64 # remove files using multiple threads when there are at least this many
+
 def _make_dir(dir):
     path = os.path.join(app.STAGING_ROOT, dir)
     os.makedirs(path,
@@ -20,35 +30,113 @@ def _make_dir(dir):
              exist_ok=True)
     return path
 
-def stage(collection: app.collection.FileCollection):
+def _link(filepath, link_path) -> typing.Union[Exception, None]:
+    '''Hard link a file, unless it is already linked. Return the error, if any.'''
+    try:
+        os.link(filepath, link_path)
+    except FileExistsError as e:
+        if not os.path.samefile(filepath, link_path): # otherwise, already staged
+            return e
+    except Exception as e:
+        return e
+    return None
+
+def stage_many(collections: list[app.collection.FileCollection]) -> list[bool]:
+    '''
+    Stage the files of many collections at once: create all of their
+    directories first, then link their files using a pool of
+    `STAGING_WORKERS` threads. Files which are already staged are skipped.
+
+    Returns, for each collection, whether all of its files were staged.
+    '''
+    staged = [True] * len(collections)
+    links = [] # (index of collection, file path, link path)
+    for i, collection in enumerate(collections):
+        try:
+            dir = _make_dir(collection.dir_path)
+            links.extend((i, filepath, os.path.join(dir, os.path.basename(filepath)))
+                         for filepath in collection.files)
+        except Exception as e:
+            app.logger.error(f'Failed to stage files: {e}')
+            staged[i] = False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=app.STAGING_WORKERS) as executor:
+        errors = list(executor.map(lambda link: _link(link[1], link[2]), links))
+    for (i, filepath, _), error in zip(links, errors):
+        if error is not None:
+            app.logger.error(f'Failed to stage file {filepath}: {error}')
+            staged[i] = False
+    return staged
+
+def stage(collection: app.collection.FileCollection) -> bool:
+    return stage_many([collection])[0]
+
+def make_project_dir(project_id: int) -> bool:
     try:
-        dir = _make_dir(collection.dir_path)
-        for filepath in collection.files:
-            os.link(filepath, os.path.join(app.STAGING_ROOT, dir, os.path.basename(filepath)))
+        _make_dir(app.collection.project_dir(project_id))
         return True
     except Exception as e:
-        app.logger.error(f'Failed to stage files: {e}')
+        app.logger.error(f'Failed to create directory for project {project_id}: {e}')
         return False
 
-def _get_user(filepath):
-    return pwd.getpwuid(os.stat(filepath).st_uid).pw_name
+def remove_project_dir(project_id: int):
+    '''Remove a project's directory, if it exists and is empty.'''
+    path = os.path.join(app.STAGING_ROOT, app.collection.project_dir(project_id))
+    try:
+        if os.path.exists(path):
+            os.rmdir(path)
+    except OSError as e:
+        app.logger.error(f'Failed to remove directory for project {project_id}: {e}')
+
+def move(dataset: app.BaseDataset, dir_path: str) -> bool:
+    '''Move the staged files of a dataset to `dir_path`.'''
+    try:
+        _make_dir(os.path.dirname(dir_path))
+        os.rename(os.path.join(app.STAGING_ROOT, dataset.dir_path),
+                  os.path.join(app.STAGING_ROOT, dir_path))
+        return True
+    except Exception as e:
+        app.logger.error(f'Failed to move dataset {dataset.uuid} to {dir_path}: {e}')
+        return False
+
+def _scan(path, files: list, dirs: list):
+    '''Collect the files under `path` which are owned by the app, and all
+    directories under and including `path`, each after its subdirectories.'''
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _scan(entry.path, files, dirs)
+            elif entry.stat(follow_symlinks=False).st_uid == APP_UID:
+                files.append(entry.path)
+    dirs.append(path)
 
 def _delete_dir(path):
+    '''Delete the app's files under `path`, then its directories from the
+    bottom up. Files belonging to others, and thus the directories which
+    contain them, are left in place.'''
     if not os.path.exists(path):
         return
-    for dirpath, dirnames, filenames in os.walk(path):
-        for filename in filenames:
-            filepath = os.path.join(dirpath, filename)
-            fileowner = _get_user(filepath)
-            if fileowner == app.APP_USER:
-                remove(filepath)
-    os.rmdir(path)
-
-def remove(dataset: app.collection.Dataset):
+    files, dirs = [], []
+    _scan(path, files, dirs)
+    if len(files) >= PARALLEL_UNLINK_THRESHOLD:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=app.STAGING_WORKERS) as executor:
+            list(executor.map(os.unlink, files))
+    else:
+        for filepath in files:
+            os.unlink(filepath)
+    errors = []
+    for dir in dirs:
+        try:
+            os.rmdir(dir)
+        except OSError as e:
+            errors.append(e)
+    if errors:
+        raise errors[-1] # the error concerning `path` itself
+
+def remove(dataset: app.BaseDataset):
     try:
         dataset_dir = os.path.join(app.STAGING_ROOT, dataset.dir_path)
         _delete_dir(dataset_dir)
     except Exception as e:
-        app.logger.error(f'Failed to remove dataset {dataset.id}: {e}')
+        app.logger.error(f'Failed to remove dataset {dataset.uuid}: {e}')
         return False
     return True
\ No newline at end of file
@@ -1,7 +1,11 @@
+import concurrent.futures
 import globus_sdk
 import datetime
+import typing
+import peewee
 
 import app.state
+import app
 
 ACL_CREATION_SCOPE='urn:globus:auth:scope:transfer.api.globus.org:all'
 
@@ -27,57 +31,321 @@ if app.GLOBUS_CLIENT_ID == '' or app.GLOBUS_CLIENT_SECRET == '':
 else:
     TRANSFER_CLIENT = _get_transfer_client()
 
-def _create_permission(dataset_uuid, dataset_dir, member_id: str) -> app.state.Permission:
-    '''Raises Globus exception.'''
-    expiry = datetime.datetime.now() + \
-            datetime.timedelta(days=app.GLOBUS_PERMISSION_DAYS)
+class PermissionResult(typing.NamedTuple):
+    '''The outcome of creating or deleting one Globus permission. `error`
+    is None if the operation succeeded.'''
+    dataset_uuid: str
+    dir_path: str
+    member_id: str
+    permission_id: typing.Union[str, None]
+    error: typing.Union[Exception, None]
+
+def _expiry() -> datetime.datetime:
+    return datetime.datetime.now() + \
+           datetime.timedelta(days=int(app.GLOBUS_PERMISSION_DAYS))
+
+def _acl_path(dir_path: str) -> str:
+    '''Globus access rules apply to absolute paths within the collection
+    (whose root is the staging root) which begin and end with "/".'''
+    path = dir_path.strip('/')
+    return f'/{path}/' if path else '/'
+
+def _create_permission(dataset_uuid, dataset_dir, member_id: str, expiry: datetime.datetime) -> PermissionResult:
+    '''Create the Globus access rule, but do not record it.'''
     rule_data = {
         "DATA_TYPE": "access",
         "principal_type": "identity",
         "principal": member_id,
-        "path": dataset_dir,
+        "path": _acl_path(dataset_dir),
         "permissions": "r",
         "expiration_date": expiry.isoformat()
     }
-    permission_id = TRANSFER_CLIENT.add_endpoint_acl_rule(app.GLOBUS_COLLECTION_ID, rule_data)
-    app.state.Permission.insert(id=permission_id,
-                                member_id=member_id,
-                                dataset_uuid=dataset_uuid,
-                                expiry=expiry.isoformat()).execute()
+    try:
+        response = TRANSFER_CLIENT.add_endpoint_acl_rule(app.GLOBUS_COLLECTION_ID, rule_data)
+    except globus_sdk.GlobusError as e:
+        return PermissionResult(dataset_uuid, dataset_dir, member_id, None, e)
+    return PermissionResult(dataset_uuid, dataset_dir, member_id, response['access_id'], None)
 
-def _delete_permission(access_rule_id):
+def _delete_rule(rule_id: str) -> typing.Union[Exception, None]:
+    '''Delete a Globus access rule. Return the error, if any.'''
     try:
-        TRANSFER_CLIENT.delete_endpoint_acl_rule(app.GLOBUS_COLLECTION_ID, access_rule_id)
-    except globus_sdk.TransferAPIError:
-        ... # TODO Log the error
+        TRANSFER_CLIENT.delete_endpoint_acl_rule(app.GLOBUS_COLLECTION_ID, rule_id)
+    except globus_sdk.GlobusAPIError as e:
+        if e.code != 'AccessRuleNotFound': # otherwise, the rule is already gone
+            return e
+    except globus_sdk.GlobusError as e:
+        return e
+    return None
+
+def _delete_permission(permission: typing.Union[app.state.Permission, app.state.ProjectPermission],
+                       dir_path) -> PermissionResult:
+    '''Delete the Globus access rule, but do not remove its record.'''
+    dataset_uuid = getattr(permission, 'dataset_uuid', None) # None for project permissions
+    error = _delete_rule(permission.id)
+    return PermissionResult(dataset_uuid, dir_path, permission.member_id, permission.id, error)
+
+def _map(function, items) -> list:
+    '''Apply `function` to each of `items`, at most `GLOBUS_MAX_WORKERS` at a time.'''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=app.GLOBUS_MAX_WORKERS) as executor:
+        return list(executor.map(function, items))
 
-def remove_permissions(dataset_uuid, dataset_dir):
-    permissions = app.state.Permission.get_by_dataset_id(dataset_uuid)
-    for permission in permissions:
-        remove_permission(dataset_uuid, dataset_dir, permission.member_id)
+def log_failure(result: PermissionResult, action='create'):
+    message = f'Failed to {action} Globus permission in collection ' + \
+        f'{app.GLOBUS_COLLECTION_ID}: Globus API response message(s): ' \
+        f'{getattr(result.error, "message", result.error)}, dataset.dir_path: ' \
+        f'{result.dir_path}, member_id: {result.member_id}'
+    code = getattr(result.error, 'code', None)
+    if code == 'Exists':
+        app.logger.info(message)
+    elif code == 'LimitExceeded':
+        app.logger.error(f'ACTION REQUIRED: ' + message)
+    else: # code == 'InvalidPath', etc.
+        app.logger.error(message)
+
+def create_permissions(requests: list[tuple[str, str, str]]) -> list[PermissionResult]:
+    '''
+    Create a Globus permission for each (dataset_uuid, dir_path, member_id)
+    in `requests`, at most `GLOBUS_MAX_WORKERS` at a time, and record the
+    permissions which were created in a single transaction.
+
+    Returns one result per request, in the order of `requests`. Failures
+    are reported in the results rather than logged.
+    '''
+    if not requests:
+        return []
+    expiry = _expiry()
+    results = _map(lambda r: _create_permission(*r, expiry), requests)
+    rows = [{'id': result.permission_id,
+             'member_id': result.member_id,
+             'dataset_uuid': result.dataset_uuid,
+             'expiry': expiry} for result in results if result.error is None]
+    with app.state.transaction():
+        for batch in peewee.chunked(rows, 100):
+            app.state.Permission.insert_many(batch).execute()
+    return results
+
+def delete_permissions(permissions: list[app.state.Permission], dir_paths: dict[str, str] = None) -> list[PermissionResult]:
+    '''
+    Delete the Globus access rules of `permissions`, at most
+    `GLOBUS_MAX_WORKERS` at a time, and remove the records of those
+    which were deleted in a single transaction.
+
+    `dir_paths`: optionally maps dataset UUIDs to directories, which are
+    only used to describe the results.
+    '''
+    if not permissions:
+        return []
+    dir_paths = dir_paths or {}
+    results = _map(lambda p: _delete_permission(p, dir_paths.get(p.dataset_uuid)), permissions)
+    deleted_ids = [result.permission_id for result in results if result.error is None]
+    with app.state.transaction():
+        for batch in peewee.chunked(deleted_ids, 100):
+            (app.state.Permission.delete()
+                                 .where(app.state.Permission.id.in_(batch))
+                                 .execute())
+    return results
+
+def remove_permissions(dataset: app.BaseDataset):
+    '''Remove all permissions to access `dataset`.'''
+    permissions = app.state.Permission.get_by_dataset_id(dataset.uuid)
+    for result in delete_permissions(list(permissions), {dataset.uuid: dataset.dir_path}):
+        if result.error is not None:
+            log_failure(result, 'remove')
 
 def remove_permission(dataset_uuid, dataset_dir, member_id: str):
     permission = app.state.Permission.get_by(member_id, dataset_uuid)
     if permission is None:
         app.logger.info(f'Permission for {member_id} to access {dataset_dir} not found.')
         return
-    try:
-        _delete_permission(permission.id)
-    except globus_sdk.GlobusError as e:
-        app.logger.error(f'Failed to remove permission for {member_id} to access {dataset_dir}: {e}')
-        return
-    permission.delete_instance()
+    for result in delete_permissions([permission], {dataset_uuid: dataset_dir}):
+        if result.error is not None:
+            log_failure(result, 'remove')
 
 def create_permission(dataset_uuid, dataset_dir, member_id: str):
+    for result in create_permissions([(dataset_uuid, dataset_dir, member_id)]):
+        if result.error is not None:
+            log_failure(result)
+
+def create_project_permissions(project_id: int, project_dir: str, member_ids: list[str]) -> list[PermissionResult]:
+    '''
+    Create a Globus permission for each of `member_ids` to access the whole
+    directory of a project (see `app.PROJECT_DIRECTORIES`), and record the
+    permissions which were created in a single transaction. The results'
+    `dataset_uuid` is None.
+    '''
+    if not member_ids:
+        return []
+    expiry = _expiry()
+    results = _map(lambda member_id: _create_permission(None, project_dir, member_id, expiry), member_ids)
+    rows = [{'id': result.permission_id,
+             'member_id': result.member_id,
+             'project_id': project_id,
+             'expiry': expiry} for result in results if result.error is None]
+    with app.state.transaction():
+        for batch in peewee.chunked(rows, 100):
+            app.state.ProjectPermission.insert_many(batch).execute()
+    return results
+
+def delete_project_permissions(project_id: int, project_dir: str, member_ids: list[str] = None) -> list[PermissionResult]:
+    '''
+    Delete the permissions of `member_ids` (by default, of all members) to
+    access the directory of a project, and remove the records of those
+    which were deleted in a single transaction.
+    '''
+    permissions = list(app.state.ProjectPermission.get_by_project_id(project_id, member_ids))
+    if not permissions:
+        return []
+    results = _map(lambda p: _delete_permission(p, project_dir), permissions)
+    deleted_ids = [result.permission_id for result in results if result.error is None]
+    with app.state.transaction():
+        for batch in peewee.chunked(deleted_ids, 100):
+            (app.state.ProjectPermission.delete()
+                                        .where(app.state.ProjectPermission.id.in_(batch))
+                                        .execute())
+    return results
+
+def _renew_rule(rule_id: str, expiry: datetime.datetime) -> typing.Union[Exception, None]:
+    '''Set a new expiration date on a Globus access rule. Return the error, if any.'''
     try:
-        _create_permission(dataset_uuid, dataset_dir, member_id)
-    except globus_sdk.GlobusAPIError as e:
-        message = f'Failed to create Globus permission in collection ' + \
-            f'{app.GLOBUS_COLLECTION_ID}: Globus API response message(s): ' \
-            f'{e.message}, dataset.dir_path: {dataset_dir}, member_id: {member_id}'
-        if e.code == 'Exists':
-            app.logger.info(message)
-        elif e.code == 'LimitExceeded':
-            app.logger.error(f'ACTION REQUIRED: ' + message)
-        else: # e.code == 'InvalidPath', etc.
-            app.logger.error(message)
\ No newline at end of file
+        TRANSFER_CLIENT.update_endpoint_acl_rule(app.GLOBUS_COLLECTION_ID, rule_id, {
+            "DATA_TYPE": "access",
+            "expiration_date": expiry.isoformat()
+        })
+    except globus_sdk.GlobusError as e:
+        return e
+    return None
+
+def renew_permissions(permissions: list[typing.Union[app.state.Permission, app.state.ProjectPermission]]) -> list[PermissionResult]:
+    '''
+    Extend the permissions, as if they had just been created, at most
+    `GLOBUS_MAX_WORKERS` at a time, and record their new expiry in a single
+    transaction. The results' `dir_path` is None.
+    '''
+    if not permissions:
+        return []
+    expiry = _expiry()
+    errors = _map(lambda p: _renew_rule(p.id, expiry), permissions)
+    results = [PermissionResult(getattr(p, 'dataset_uuid', None), None, p.member_id, p.id, error)
+               for p, error in zip(permissions, errors)]
+    renewed_ids = [result.permission_id for result in results if result.error is None]
+    with app.state.transaction():
+        for batch in peewee.chunked(renewed_ids, 100):
+            app.state.Permission.update_expiry(batch, expiry)
+            app.state.ProjectPermission.update_expiry(batch, expiry)
+    return results
+
+def _list_rules() -> dict[tuple[str, str], list[dict]]:
+    '''Get the collection's access rules for individual identities, indexed
+    by (identity ID, path). There may be more than one rule for the same
+    identity and path.'''
+    rules = {}
+    for rule in TRANSFER_CLIENT.endpoint_acl_list(app.GLOBUS_COLLECTION_ID):
+        if rule['principal_type'] == 'identity':
+            rules.setdefault((rule['principal'], rule['path']), []).append(rule)
+    return rules
+
+def _parse_expiry(rule: dict) -> datetime.datetime:
+    if not rule.get('expiration_date'):
+        return _expiry()
+    expiry = datetime.datetime.fromisoformat(rule['expiration_date'].replace('Z', '+00:00'))
+    if expiry.tzinfo is not None: # records are in local time, see _expiry
+        expiry = expiry.astimezone().replace(tzinfo=None)
+    return expiry
+
+def _record_rules(rules: list[dict], desired: dict[tuple[str, str], tuple]) -> int:
+    '''Record existing access rules which the app has no record of.
+    Return the number of records added.'''
+    recorded_ids = {p.id for p in app.state.Permission.select(app.state.Permission.id)} | \
+                   {p.id for p in app.state.ProjectPermission.select(app.state.ProjectPermission.id)}
+    dataset_rows = []
+    project_rows = []
+    for rule in rules:
+        if rule['id'] in recorded_ids:
+            continue
+        dataset_uuid, project_id = desired[(rule['principal'], rule['path'])]
+        row = {'id': rule['id'], 'member_id': rule['principal'], 'expiry': _parse_expiry(rule)}
+        if dataset_uuid is not None:
+            dataset_rows.append(dict(row, dataset_uuid=dataset_uuid))
+        else:
+            project_rows.append(dict(row, project_id=project_id))
+    with app.state.transaction():
+        for batch in peewee.chunked(dataset_rows, 100):
+            app.state.Permission.insert_many(batch).execute()
+        for batch in peewee.chunked(project_rows, 100):
+            app.state.ProjectPermission.insert_many(batch).execute()
+    return len(dataset_rows) + len(project_rows)
+
+def _forget_rules(rule_ids: set[str]) -> int:
+    '''Remove the records of access rules. Return the number removed.'''
+    removed = 0
+    with app.state.transaction():
+        for batch in peewee.chunked(list(rule_ids), 100):
+            removed += app.state.Permission.delete().where(app.state.Permission.id.in_(batch)).execute()
+            removed += app.state.ProjectPermission.delete().where(app.state.ProjectPermission.id.in_(batch)).execute()
+    return removed
+
+def reconcile(desired: dict[tuple[str, str], tuple], managed_dir_paths: set[str]) -> dict[str, int]:
+    '''
+    Make the collection's access rules, and the app's records of them,
+    match the `desired` permissions, using a single listing of the
+    collection's rules and only as many changes as needed.
+
+    `desired`: maps (member_id, dir_path) of each permission which should
+    exist to (dataset_uuid, project_id), exactly one of which is None.
+    `managed_dir_paths`: the directories whose rules belong to the app. Rules
+    for other paths are left alone, even if they are not desired.
+
+    Returns counts of the changes made, and of those which failed.
+    '''
+    recorded_ids = {p.id for p in app.state.Permission.select(app.state.Permission.id)} | \
+                   {p.id for p in app.state.ProjectPermission.select(app.state.ProjectPermission.id)}
+    listed = _list_rules()
+    desired = {(member_id, _acl_path(dir_path)): value
+               for (member_id, dir_path), value in desired.items()}
+    managed_paths = {_acl_path(dir_path) for dir_path in managed_dir_paths} | \
+                    {path for _, path in desired}
+    dir_paths = {_acl_path(dir_path): dir_path for _, dir_path in desired}
+
+    actual = {}
+    duplicates = []
+    for key, rules in listed.items():
+        rules.sort(key=lambda rule: rule['id'] not in recorded_ids) # keep a recorded rule, if any
+        actual[key] = rules[0]
+        if key[1] in managed_paths:
+            duplicates += rules[1:]
+    stale = [rule for key, rule in actual.items()
+             if key not in desired and key[1] in managed_paths] + duplicates
+    errors = _map(lambda rule: _delete_rule(rule['id']), stale)
+    removed_ids = set()
+    for rule, error in zip(stale, errors):
+        if error is None:
+            removed_ids.add(rule['id'])
+        else:
+            app.logger.error(f"Failed to remove access rule for {rule['principal']} to access {rule['path']}: {error}")
+
+    missing = [key for key in desired if key not in actual]
+    requests = [(desired[key][0], dir_paths[key[1]], key[0]) for key in missing
+                if desired[key][0] is not None]
+    results = create_permissions(requests)
+    project_members = {}
+    for key in missing:
+        if desired[key][0] is None:
+            project_members.setdefault((desired[key][1], dir_paths[key[1]]), []).append(key[0])
+    for (project_id, project_dir), member_ids in project_members.items():
+        results += create_project_permissions(project_id, project_dir, member_ids)
+
+    kept = [rule for key, rule in actual.items() if key in desired]
+    drifted_ids = recorded_ids - {rule['id'] for rules in listed.values() for rule in rules}
+    report = {
+        'rules': sum(len(rules) for rules in listed.values()),
+        'added': len([result for result in results if result.error is None]),
+        'removed': len(removed_ids),
+        'failed': len([result for result in results if result.error is not None]) + \
+                  len(stale) - len(removed_ids),
+        'records_added': _record_rules(kept, desired),
+        'records_removed': _forget_rules(drifted_ids | removed_ids),
+    }
+    for result in results:
+        if result.error is not None:
+            log_failure(result)
+    return report
\ No newline at end of file
@@ -4,38 +4,55 @@ of the app's modules and uses them to get data from SMRT Link, update
 the app's state, create a remove files, and create and remove Globus 
 permissions.
 '''
+import datetime
 import typing
+import os
 
 import app.filesystem
 import app.collection
 import app.smrtlink
 import app.globus
 import app.state
+import app.lock
 import app.job
 import app
 
-def expired_permissions():
+def sweep_permissions():
     """Bring the app's database of permissions up to date by removing
-    the records of any permissions that should be expired."""
-    app.state.Permission.remove_expired()
+    the records of any permissions that should be expired, then renew
+    the permissions of current project members which are about to expire."""
+    try:
+        app.state.Permission.remove_expired()
+        app.state.ProjectPermission.remove_expired()
+        before = datetime.datetime.now() + datetime.timedelta(days=app.PERMISSION_RENEWAL_DAYS)
+        permissions = list(app.state.Permission.get_renewable(before)) + \
+                      list(app.state.ProjectPermission.get_renewable(before))
+        results = app.globus.renew_permissions(permissions)
+    except Exception as e:
+        app.logger.error(f'Failed to sweep Globus permissions: {e}')
+        return
+    _log_permission_failures(results, 'renew')
 
 def _stage_analyses(completed, pending):
     '''
     Stage completed analyses, and track pending analyses.
     '''
-    for analysis in completed:
-        app.filesystem.stage(analysis)
-    for completed_analysis in app.job.track(pending):
-        app.filesystem.stage(completed_analysis)
+    app.filesystem.stage_many(completed)
+    app.job.track(pending)
 
 def _handle_removed_datasets(project_id, dataset_dicts):
     current_ids = [ds['uuid'] for ds in dataset_dicts]
     removed_datasets = app.state.Dataset.get_removed_datasets(project_id, current_ids)
     for dataset in removed_datasets:
-        app.filesystem.remove(dataset)
-        app.globus.remove_permissions(dataset)
+        with app.lock.DATASETS(dataset.uuid):
+            # the dataset may have been reassigned to another project in the meantime
+            dataset = app.state.Dataset.get_by_dataset_uuid(dataset.uuid)
+            if dataset is None or dataset.project_id != project_id:
+                continue
+            app.filesystem.remove(dataset)
+            app.globus.remove_permissions(dataset)
 
-def _handle_dataset_analyses(dataset: app.collection.Dataset):
+def _handle_dataset_analyses(dataset: app.collection.DatasetRecord):
     try:
         completed, pending = app.job.get_analyses(dataset)
     except Exception as e:
@@ -43,49 +60,91 @@ def _handle_dataset_analyses(dataset: app.collection.Dataset):
         return
     _stage_analyses(completed, pending)
 
-def _handle_new_dataset(dataset_d) -> typing.Union[app.collection.Dataset, None]:
+def _handle_new_dataset(dataset_d) -> typing.Union[app.collection.DatasetRecord, None]:
+    '''Stage a dataset which has not been handled before. Only a record of the
+    dataset is returned so that its parsed XML and children can be freed.
+    The caller is responsible for adding the dataset to the database.'''
     try:
         dataset = app.collection.Dataset(**dataset_d)
     except Exception as e:
         app.logger.error(f"Cannot handle SMRT Link dataset {dataset_d['uuid']}: {e}.")
         return None
-    if app.filesystem.stage(dataset):
-        app.state.Dataset.insert(project_id=dataset_d['projectId'],
-                                 uuid=dataset_d['uuid'],
-                                 dir_path=dataset.dir_path).execute()
-        _handle_dataset_analyses(dataset)
-        if type(dataset) is app.collection.Parent:
-            for child in dataset.child_datasets:
-                if app.filesystem.stage(child):
-                    _handle_dataset_analyses(child)
-        return dataset
+    collections = [dataset]
+    if type(dataset) is app.collection.Parent:
+        collections.extend(dataset.child_datasets)
+    staged = app.filesystem.stage_many(collections)
+    if not staged[0]:
+        return None
+    records = [c.record() if isinstance(c, app.collection.Dataset) else None for c in collections]
+    del dataset, collections
+    for record, was_staged in zip(records, staged):
+        if record is not None and was_staged:
+            _handle_dataset_analyses(record)
+    return records[0]
+
+def _move_to_project_dir(dataset: app.state.Dataset, project_id: int) -> typing.Union[str, None]:
+    '''Move a reassigned dataset into the directory of its new project.
+    Return the dataset's new directory path, if it was moved.'''
+    dir_path = os.path.join(app.collection.project_dir(project_id),
+                            os.path.basename(dataset.dir_path))
+    if dir_path != dataset.dir_path and app.filesystem.move(dataset, dir_path):
+        return dir_path
     return None
 
 def _handle_current_datasets(dataset_dicts) -> list[app.BaseDataset]:
     '''
     Get or create BaseDataset instances and update app state with respect to 
     datasets. State updates include adding new datasets and updating the 
-    `project_id` of reassigned (existing) datasets.
+    `project_id` of reassigned (existing) datasets. The datasets are looked
+    up with one query, and all state updates are made in one transaction.
     '''
     datasets = []
-    reassigned_dataset_uuids = []
-    for dataset_d in dataset_dicts:
-        dataset = app.state.Dataset.get_by_dataset_uuid(dataset_d['uuid'])
-        if dataset is None:
-            dataset = _handle_new_dataset(dataset_d)
-        else: 
-            if dataset.project_id is not dataset_d['projectId']:
-                reassigned_dataset_uuids.append(dataset.uuid)
-                dataset.update_project_id(dataset_d['projectId'])
-        if dataset is not None:
-            datasets.append(dataset)
-    return datasets, reassigned_dataset_uuids
+    new_rows = []
+    project_ids = {} # uuid -> new project ID of each reassigned dataset
+    dir_paths = {} # uuid -> new directory of each moved dataset
+    uuids = [dataset_d['uuid'] for dataset_d in dataset_dicts]
+    with app.lock.DATASETS(*uuids):
+        known_datasets = app.state.Dataset.get_by_uuids(uuids)
+        for dataset_d in dataset_dicts:
+            dataset = known_datasets.get(dataset_d['uuid'])
+            if dataset is None:
+                dataset = _handle_new_dataset(dataset_d)
+                if dataset is not None:
+                    new_rows.append({'uuid': dataset.uuid,
+                                     'project_id': dataset_d['projectId'],
+                                     'dir_path': dataset.dir_path})
+            elif dataset.project_id != dataset_d['projectId']:
+                project_ids[dataset.uuid] = dataset.project_id = dataset_d['projectId']
+                if app.PROJECT_DIRECTORIES:
+                    dir_path = _move_to_project_dir(dataset, dataset_d['projectId'])
+                    if dir_path is not None:
+                        dir_paths[dataset.uuid] = dataset.dir_path = dir_path
+            if dataset is not None:
+                datasets.append(dataset)
+        with app.state.transaction():
+            if new_rows:
+                app.state.Dataset.add_many(new_rows)
+            if project_ids:
+                app.state.Dataset.update_project_ids(project_ids)
+            if dir_paths:
+                app.state.Dataset.update_dir_paths(dir_paths)
+    return datasets, list(project_ids)
+
+def _log_permission_failures(results: list[app.globus.PermissionResult], action):
+    for result in results:
+        if result.error is not None:
+            app.globus.log_failure(result, action)
 
 def _handle_removed_members(project_id, member_ids, datasets: list[app.BaseDataset]):
-    removed_members = app.state.ProjectMember.get_removed_members(project_id, member_ids)
+    removed_members = list(app.state.ProjectMember.get_removed_members(project_id, member_ids))
+    if not removed_members:
+        return
+    permissions = app.state.Permission.get_by_members([member.member_id for member in removed_members],
+                                                      [dataset.uuid for dataset in datasets])
+    dir_paths = {dataset.uuid: dataset.dir_path for dataset in datasets}
+    results = app.globus.delete_permissions(list(permissions), dir_paths)
+    _log_permission_failures(results, 'remove')
     for member in removed_members:
-        for dataset in datasets:
-            app.globus.remove_permission(dataset.uuid, dataset.dir_path, member.member_id)
         member.delete_instance()
 
 def _handle_current_members(project_id, member_ids):
@@ -93,63 +152,187 @@ def _handle_current_members(project_id, member_ids):
     Update app state with respect to project members. Return the list of
     project members which have been added to the project since the last update.
     '''
-    new_members = []
-    for member_id in member_ids:
-        if app.state.ProjectMember.exists(project_id, member_id):
-            new_members.append(member_id)
-        else:
-            app.state.ProjectMember.insert(project_id=project_id, member_id=member_id).execute()
+    current_member_ids = app.state.ProjectMember.get_member_ids(project_id)
+    new_members = [member_id for member_id in dict.fromkeys(member_ids)
+                   if member_id not in current_member_ids]
+    if new_members:
+        app.state.ProjectMember.add_many(project_id, new_members)
     return new_members
 
 def _handle_permissions(datasets, reassigned_dataset_ids, member_ids, new_member_ids):
+    requests = [] # (dataset_uuid, dir_path, member_id) of each permission to create
     for dataset in datasets:
         if type(dataset) is app.state.Dataset:
             members_to_add = new_member_ids
             if dataset.uuid in reassigned_dataset_ids:
                 app.globus.remove_permissions(dataset)
                 members_to_add = member_ids
-            for member in members_to_add:
-                app.globus.create_permission(dataset.uuid, dataset.dir_path, member)
-        elif type(dataset) is app.collection.Dataset:
-            for member in member_ids:
-                app.globus.create_permission(dataset.uuid, dataset.dir_path, member)
+            requests.extend((dataset.uuid, dataset.dir_path, member) for member in members_to_add)
+        elif type(dataset) is app.collection.DatasetRecord: # newly handled
+            requests.extend((dataset.uuid, dataset.dir_path, member) for member in member_ids)
         else:
             ...
+    if requests:
+        results = app.globus.create_permissions(requests)
+        _log_permission_failures(results, 'create')
+
+def _handle_project_permissions(project_id, datasets, reassigned_dataset_ids, member_ids):
+    '''
+    Used instead of `_handle_permissions` when `app.PROJECT_DIRECTORIES` is
+    set: each member gets one permission to access the project directory,
+    rather than one per dataset.
+    '''
+    for dataset in datasets:
+        if dataset.uuid in reassigned_dataset_ids:
+            app.globus.remove_permissions(dataset) # permissions to its former location
+    project_dir = app.collection.project_dir(project_id)
+    permitted_member_ids = app.state.ProjectPermission.get_member_ids(project_id)
+    removed_member_ids = [m for m in permitted_member_ids if m not in member_ids]
+    new_member_ids = [m for m in member_ids if m not in permitted_member_ids]
+    if removed_member_ids:
+        results = app.globus.delete_project_permissions(project_id, project_dir, removed_member_ids)
+        _log_permission_failures(results, 'remove')
+    if new_member_ids and app.filesystem.make_project_dir(project_id):
+        results = app.globus.create_project_permissions(project_id, project_dir, new_member_ids)
+        _log_permission_failures(results, 'create')
 
 def _handle_project(project_id: int, dataset_dicts: list[dict], member_ids: list[str]):
-    project_datasets, reassigned_dataset_uuids = _handle_current_datasets(dataset_dicts)
+    fingerprint = app.smrtlink.datasets_fingerprint(dataset_dicts)
+    datasets_changed = fingerprint != app.state.ProjectDatasets.get_fingerprint(project_id)
+    if datasets_changed:
+        project_datasets, reassigned_dataset_uuids = _handle_current_datasets(dataset_dicts)
+    else: # only the members can have changed
+        project_datasets, reassigned_dataset_uuids = app.state.Dataset.get_by_project_id(project_id), []
     new_member_ids = _handle_current_members(project_id, member_ids)
-    _handle_removed_datasets(project_id, dataset_dicts)
+    if datasets_changed:
+        _handle_removed_datasets(project_id, dataset_dicts)
     _handle_removed_members(project_id, member_ids, project_datasets)
-    _handle_permissions(project_datasets, reassigned_dataset_uuids, member_ids, new_member_ids)
+    if app.PROJECT_DIRECTORIES:
+        _handle_project_permissions(project_id, project_datasets, reassigned_dataset_uuids, member_ids)
+    else:
+        _handle_permissions(project_datasets, reassigned_dataset_uuids, member_ids, new_member_ids)
+    if datasets_changed and len(project_datasets) == len(dataset_dicts):
+        # every dataset was handled; otherwise, try the rest again at the next update
+        app.state.ProjectDatasets.set_fingerprint(project_id, fingerprint)
 
 def updated_project(project_id):
     try:
-        dataset_dicts, member_ids = app.smrtlink.get_project(project_id)
-        _handle_project(project_id, dataset_dicts, member_ids)
+        with app.lock.PERMISSIONS.shared(), app.lock.PROJECTS(project_id):
+            dataset_dicts, member_ids = app.smrtlink.get_project(project_id)
+            _handle_project(project_id, dataset_dicts, member_ids)
     except Exception as e:
         app.logger.error(f'Failed to handle update to project {project_id}: {e}')
         return
 
+def _retry_failed_projects():
+    '''Try again to handle new projects which could not be handled before.'''
+    for retry in app.state.ProjectRetry.get_due():
+        try:
+            with app.lock.PERMISSIONS.shared(), app.lock.PROJECTS(retry.project_id):
+                dataset_dicts, member_ids = app.smrtlink.get_project(retry.project_id)
+                _handle_project(retry.project_id, dataset_dicts, member_ids)
+            retry.delete_instance()
+        except Exception as e:
+            if retry.attempts + 1 >= app.PROJECT_RETRY_LIMIT:
+                app.logger.error(f'Giving up on new project {retry.project_id} after {retry.attempts + 1} attempts: {e}')
+                retry.delete_instance()
+            else:
+                retry.failed(str(e))
+
 def new_project():
-    try:
-        project_id, dataset_dicts, member_ids = app.smrtlink.get_new_project()
-        _handle_project(project_id, dataset_dicts, member_ids)
-    except Exception as e:
-        app.logger.error(f'Failed to handle new project: {e}')
-        return
+    '''Handle each project created since the last new project was handled.
+    A project which cannot be handled is recorded as a `ProjectRetry`, to be
+    tried again at a later call, so that it does not hold up the rest.'''
+    with app.lock.NEW_PROJECTS:
+        _retry_failed_projects()
+        try:
+            for project_id, dataset_dicts, member_ids in app.smrtlink.get_new_projects(app.state.LastProject.latest()):
+                try:
+                    with app.lock.PERMISSIONS.shared(), app.lock.PROJECTS(project_id):
+                        _handle_project(project_id, dataset_dicts, member_ids)
+                except Exception as e:
+                    app.logger.error(f'Failed to handle new project {project_id}: {e}')
+                    app.state.ProjectRetry.add(project_id, str(e))
+                app.state.LastProject.set(project_id)
+        except Exception as e:
+            app.logger.error(f'Failed to get new projects: {e}')
 
 def deleted_project(project_id):
-    datasets = app.state.Dataset.get_by_project_id(project_id)
+    with app.lock.PERMISSIONS.shared(), app.lock.PROJECTS(project_id):
+        datasets = app.state.Dataset.get_by_project_id(project_id)
+        for dataset in datasets:
+            with app.lock.DATASETS(dataset.uuid):
+                dataset = app.state.Dataset.get_by_dataset_uuid(dataset.uuid)
+                if dataset is None or dataset.project_id != project_id:
+                    continue
+                app.filesystem.remove(dataset)
+                app.globus.remove_permissions(dataset)
+                dataset.delete_instance()
+        project_dir = app.collection.project_dir(project_id)
+        results = app.globus.delete_project_permissions(project_id, project_dir)
+        _log_permission_failures(results, 'remove')
+        app.filesystem.remove_project_dir(project_id)
+        app.state.ProjectMember.remove_project(project_id)
+        app.state.ProjectDatasets.remove_project(project_id)
+
+def _in_project_dir(dataset: app.state.Dataset) -> bool:
+    '''Whether a dataset is staged in the directory of its project.'''
+    return os.path.dirname(dataset.dir_path) == app.collection.project_dir(dataset.project_id)
+
+def _desired_permissions() -> tuple[dict[tuple[str, str], tuple], set[str]]:
+    '''
+    Derive from app state the permissions which should exist, in the form
+    expected by `app.globus.reconcile`, along with the directories whose
+    permissions are managed by the app.
+
+    Permissions follow where each dataset is actually staged rather than
+    `app.PROJECT_DIRECTORIES`, so that datasets staged before the setting
+    was changed keep their permissions: members get access to the
+    directory of a dataset staged on its own, and to the project directory
+    of one staged there.
+    '''
+    datasets = list(app.state.Dataset.select())
+    members = list(app.state.ProjectMember.select())
+    project_ids = {dataset.project_id for dataset in datasets} | \
+                  {member.project_id for member in members}
+    managed_dir_paths = {dataset.dir_path for dataset in datasets} | \
+                        {app.collection.project_dir(project_id) for project_id in project_ids}
+    project_datasets = {}
     for dataset in datasets:
-        app.filesystem.remove(dataset)
-        app.globus.remove_permissions(dataset)
-        dataset.delete_instance()
+        project_datasets.setdefault(dataset.project_id, []).append(dataset)
+    desired = {}
+    for member in members:
+        project_dir = app.collection.project_dir(member.project_id)
+        if app.PROJECT_DIRECTORIES:
+            desired[(member.member_id, project_dir)] = (None, member.project_id)
+        for dataset in project_datasets.get(member.project_id, []):
+            if _in_project_dir(dataset):
+                desired[(member.member_id, project_dir)] = (None, member.project_id)
+            else:
+                desired[(member.member_id, dataset.dir_path)] = (dataset.uuid, None)
+    return desired, managed_dir_paths
 
-def new_analyses():
+def reconcile_permissions():
+    '''Bring the Globus permissions, and the app's records of them, in line
+    with the members and datasets of each project. Projects are not handled
+    meanwhile, so that the permissions do not change between reading the
+    desired ones and listing the actual ones.'''
     try:
-        pending_analyses, completed_analyses = app.job.get_new_analyses()
+        with app.lock.PERMISSIONS.exclusive():
+            desired, managed_dir_paths = _desired_permissions()
+            for project_id in {project_id for _, project_id in desired.values() if project_id is not None}:
+                app.filesystem.make_project_dir(project_id)
+            report = app.globus.reconcile(desired, managed_dir_paths)
     except Exception as e:
-        app.logger.error(f'Failed to update analyses: {e}')
+        app.logger.error(f'Failed to reconcile Globus permissions: {e}')
         return
-    _stage_analyses(completed_analyses, pending_analyses)
\ No newline at end of file
+    app.logger.info(f'Reconciled Globus permissions: {report}')
+
+def new_analyses() -> bool:
+    '''Stage the analyses of jobs created since the last update. Return
+    whether jobs remain to be handled by another call.'''
+    try:
+        return app.job.sync(_stage_analyses)
+    except Exception as e:
+        app.logger.error(f'Failed to update analyses: {e}')
+        return False
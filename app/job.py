@@ -1,6 +1,8 @@
-import time
-import concurrent.futures
+import threading
+import datetime
+import typing
 
+import app.filesystem
 import app.collection
 import app.smrtlink
 import app.state
@@ -10,81 +12,309 @@ FAIL_STATES = {'FAILED', 'TERMINATED', 'ABORTED'}
 PENDING_STATES = {'CREATED', 'SUBMITTED', 'RUNNING'}
 SUCCESSFUL = 'SUCCESSFUL'
 
+def _get_completed(jobs: list[dict], dir_paths: dict[int, list[str]]) -> dict:
+    '''Get the files of successful jobs, all at once. Returns a dict of each
+    job's id to its completed analyses, one in each of the job's
+    `dir_paths`, or to the exception which prevented getting the files.'''
+    files = app.smrtlink.get_jobs_files([job['id'] for job in jobs])
+    completed = {}
+    for job in jobs:
+        job_files = files[job['id']]
+        if isinstance(job_files, Exception):
+            completed[job['id']] = job_files
+        else:
+            completed[job['id']] = [app.collection.CompletedAnalysis(dir_path, job, job_files)
+                                    for dir_path in dir_paths[job['id']]]
+    return completed
+
+def _index_jobs(jobs: list[dict], dataset_uuids: dict):
+    '''Record the datasets of jobs in the `DatasetJob` index. Jobs whose
+    datasets could not be fetched (see `app.smrtlink.get_jobs_datasets`)
+    are left out.'''
+    rows = [{'dataset_uuid': uuid, 'job_id': job['id'], 'job_name': job['name'], 'state': job['state']}
+            for job in jobs if not isinstance(dataset_uuids[job['id']], Exception)
+            for uuid in dataset_uuids[job['id']]]
+    with app.state.transaction():
+        app.state.DatasetJob.add_many(rows)
+
+def _get_indexed_jobs(dataset_uuid: str) -> list[dict]:
+    '''Get the jobs of a dataset from the `DatasetJob` index. SMRT Link is
+    only asked for the current state of jobs which were pending when last
+    seen, since the state of a job which has finished does not change.'''
+    jobs = {row.job_id: {'id': row.job_id, 'name': row.job_name, 'state': row.state}
+            for row in app.state.DatasetJob.get_by_dataset_uuid(dataset_uuid)}
+    pending_ids = [id for id, job in jobs.items() if job['state'] in PENDING_STATES]
+    if pending_ids:
+        current = app.smrtlink.get_jobs(pending_ids)
+        jobs.update(current)
+        with app.state.transaction():
+            app.state.DatasetJob.update_states({id: job['state'] for id, job in current.items()})
+    return list(jobs.values())
+
 def get_analyses(dataset):
     completed = []
     pending = []
-    jobs = app.smrtlink.get_dataset_jobs(dataset.id)
+    if app.state.JobIndexUpdate.complete():
+        jobs = _get_indexed_jobs(dataset.uuid)
+    else:
+        jobs = app.smrtlink.get_dataset_jobs(dataset.uuid)
+    successful = [job for job in jobs if job['state'] == SUCCESSFUL]
+    dir_paths = {job['id']: [dataset.dir_path] for job in successful}
+    for job_id, analyses in _get_completed(successful, dir_paths).items():
+        if isinstance(analyses, Exception):
+            app.logger.error(f'Failed to get files of analysis job {job_id}: {analyses}')
+        else:
+            completed.extend(analyses)
     for job in jobs:
-        if job['state'] in FAIL_STATES:
-            continue
-        if job['state'] is SUCCESSFUL:
-            files = app.smrtlink.get_job_files(job['id'])
-            completed.append(app.collection.CompletedAnalysis(dataset.dir_path, job, files))
-        elif job['state'] in PENDING_STATES:
+        if job['state'] in PENDING_STATES:
             pending.append(app.collection.PendingAnalysis(dataset.dir_path, job))
     return completed, pending
 
-def _get_analyses(jobs):
-    '''Returns a tuple of completed and pending analyses
+def _get_jobs_analyses(jobs: list[dict]) -> dict:
+    '''Returns a dict of the id of each job to either a tuple of the job's
+    completed and pending analyses, one for each of the job's datasets which
+    has been handled by the app, or the exception which prevented getting
+    them. SMRT Link is queried for all of the jobs at once. The datasets of
+    every job are indexed, including those of jobs in project 1.
     '''
-    completed = []
-    pending = []
+    results = {job['id']: ([], []) for job in jobs if job['state'] in FAIL_STATES}
+    jobs = [job for job in jobs if job['state'] not in FAIL_STATES]
+    dataset_uuids = app.smrtlink.get_jobs_datasets([job['id'] for job in jobs])
+    _index_jobs(jobs, dataset_uuids)
+    datasets = app.state.Dataset.get_by_uuids(
+        [uuid for uuids in dataset_uuids.values() if not isinstance(uuids, Exception) for uuid in uuids])
+    dir_paths = {}
     for job in jobs:
-        dataset_ids = app.smrtlink.get_job_datasets(job['id'])
-        for dataset_id in dataset_ids:
-            if job['state'] in FAIL_STATES:
-                continue 
-            dataset = app.state.Dataset.get_by_id(dataset_id)
-            if job['state'] is SUCCESSFUL:
-                files = app.smrtlink.get_job_files(job['id'])
-                completed.append(app.collection.CompletedAnalysis(dataset.dir_path, job, files))
-            elif job['state'] in PENDING_STATES:
-                pending.append(app.collection.PendingAnalysis(dataset.dir_path, job))
-            else:
-                raise ValueError(f"Unexpected job state: {job['state']}")
-    return completed, pending
+        uuids = dataset_uuids[job['id']]
+        if isinstance(uuids, Exception):
+            results[job['id']] = uuids
+        elif job.get('projectId') == 1: # indexed, but analyses in project 1 are not synced
+            results[job['id']] = ([], [])
+        elif job['state'] not in PENDING_STATES | {SUCCESSFUL}:
+            results[job['id']] = ValueError(f"Unexpected job state: {job['state']}")
+        else:
+            dir_paths[job['id']] = [datasets[uuid].dir_path for uuid in uuids if uuid in datasets]
+            results[job['id']] = ([], [app.collection.PendingAnalysis(dir_path, job)
+                                       for dir_path in dir_paths[job['id']]])
+    successful = [job for job in jobs if job['state'] == SUCCESSFUL and dir_paths.get(job['id'])]
+    for job_id, completed in _get_completed(successful, dir_paths).items():
+        results[job_id] = completed if isinstance(completed, Exception) else (completed, [])
+    return results
 
-def get_new_analyses():
-    '''Collect all jobs created after the last update and belonging
-    to any project other than project 1.
-    '''
+def _sync_jobs(jobs: list[dict], stage) -> dict[int, str]:
+    '''Pass the analyses of each job to `stage`. Return the error which
+    prevented this for each job it was prevented for.'''
+    errors = {}
+    for job_id, analyses in _get_jobs_analyses(jobs).items():
+        if isinstance(analyses, Exception):
+            app.logger.error(f'Failed to handle analysis job {job_id}: {analyses}')
+            errors[job_id] = str(analyses)
+        else:
+            stage(*analyses)
+    return errors
+
+def _pages(jobs: list[dict]) -> typing.Iterator[list[dict]]:
+    '''Split jobs, sorted by `createdAt`, into pages of at least
+    `app.JOB_SYNC_PAGE_SIZE` jobs. Jobs created at the same time are kept in
+    the same page so that the cursor never falls between them.'''
+    page = []
+    for job in jobs:
+        if len(page) >= app.JOB_SYNC_PAGE_SIZE and job['createdAt'] != page[-1]['createdAt']:
+            yield page
+            page = []
+        page.append(job)
+    if page:
+        yield page
+
+def _retry_failed_jobs(stage):
+    '''Try again to handle jobs which could not be handled before.'''
+    retries = app.state.JobRetry.get_due(app.JOB_SYNC_PAGE_SIZE)
+    if not retries:
+        return
     try:
-        jobs = app.smrtlink.get_jobs_created_after(app.state.LastJobUpdate.time())
-        completed, pending = _get_analyses(jobs)
-        latest_timestamp = sorted([job['createdAt'] for job in jobs])[-1]
-        app.state.LastJobUpdate.set(latest_timestamp) # only update if _get_analyses is successful
-        return completed, pending
+        jobs = app.smrtlink.get_jobs([retry.job_id for retry in retries])
+        errors = _sync_jobs(list(jobs.values()), stage)
+        missing = 'Job not found in SMRT Link'
     except Exception as e:
-        raise Exception(f'Cannot get new analyses: {e}')
+        app.logger.error(f'Failed to retry analysis jobs: {e}')
+        jobs, errors, missing = {}, {}, str(e)
+    for retry in retries:
+        error = errors.get(retry.job_id) if retry.job_id in jobs else missing
+        if error is None:
+            retry.delete_instance()
+        elif retry.attempts + 1 >= app.JOB_RETRY_LIMIT:
+            app.logger.error(f'Giving up on analysis job {retry.job_id} after {retry.attempts + 1} attempts: {error}')
+            retry.delete_instance()
+        else:
+            retry.failed(error)
+
+def _backfill_index() -> bool:
+    '''Index the jobs which were synced before the `DatasetJob` index
+    existed, a page at a time. At most `app.JOB_SYNC_MAX_PAGES` pages are
+    indexed per call. Returns whether jobs remain to be indexed.'''
+    index_update = app.state.JobIndexUpdate.current()
+    if index_update.timestamp >= index_update.until:
+        return False
+    jobs = [job for job in app.smrtlink.get_jobs_created_after(index_update.timestamp)
+            if job['createdAt'] <= index_update.until and job['state'] not in FAIL_STATES]
+    jobs.sort(key=lambda job: job['createdAt'])
+    for page_number, page in enumerate(_pages(jobs)):
+        if page_number == app.JOB_SYNC_MAX_PAGES:
+            return True
+        dataset_uuids = app.smrtlink.get_jobs_datasets([job['id'] for job in page])
+        _index_jobs(page, dataset_uuids)
+        errors = [uuids for uuids in dataset_uuids.values() if isinstance(uuids, Exception)]
+        if errors: # leave the page to be indexed again, so that no job is missed
+            app.logger.error(f'Failed to index {len(errors)} analysis jobs: {errors[0]}')
+            return False
+        app.state.JobIndexUpdate.set(page[-1]['createdAt'])
+    app.state.JobIndexUpdate.set(index_update.until)
+    return False
+
+def sync(stage) -> bool:
+    '''
+    Pass the analyses of jobs created since the last sync to `stage`, a
+    function taking a list of completed and a list of pending analyses.
 
-MAX_POLLING_TIME = 86400
-POLL_RATE = 30
+    Jobs are handled in the order they were created, a page at a time. After
+    each page, the `LastJobUpdate` cursor is advanced past the page and the
+    jobs which could not be handled are recorded as `JobRetry`s, so that a
+    job is never handled twice and a failing job does not hold up the rest.
+    At most `app.JOB_SYNC_MAX_PAGES` pages are handled per call. Only the
+    handling is paged: every job since the cursor is still fetched from
+    SMRT Link in one request, which has no way to limit how many jobs it
+    returns. The cursor does keep each request to the jobs not yet synced.
+    The datasets of each job are recorded in the `DatasetJob` index, which
+    is used by `get_analyses` once it is complete. Returns whether jobs
+    remain to be synced or indexed.
+    '''
+    _retry_failed_jobs(stage)
+    jobs = app.smrtlink.get_jobs_created_after(app.state.LastJobUpdate.time())
+    jobs.sort(key=lambda job: job['createdAt'])
+    for page_number, page in enumerate(_pages(jobs)):
+        if page_number == app.JOB_SYNC_MAX_PAGES:
+            return True
+        errors = _sync_jobs(page, stage)
+        with app.state.transaction():
+            app.state.JobRetry.add_many(errors)
+            app.state.LastJobUpdate.set(page[-1]['createdAt'])
+    if _backfill_index():
+        return True
+    app.state.JobIndexUpdate.set_caught_up()
+    return False
+
+MAX_POLLING_TIME = 86400 # seconds after which a job is no longer checked on
+
+def _next_interval(pending_job: app.state.PendingJob, state: str) -> float:
+    '''Check again soon after a job's state changes, then less and less often.'''
+    if state != pending_job.state:
+        return app.JOB_POLL_MIN_INTERVAL
+    return min(pending_job.interval * 2, app.JOB_POLL_MAX_INTERVAL)
+
+def _reschedule(pending_jobs: list[app.state.PendingJob], state: str, now: datetime.datetime):
+    '''Record a job's state and when to check on it next.'''
+    with app.state.transaction():
+        for pending_job in pending_jobs:
+            pending_job.interval = _next_interval(pending_job, state)
+            pending_job.next_check = now + datetime.timedelta(seconds=pending_job.interval)
+            pending_job.state = state
+            pending_job.save()
 
-def _poll(analysis: app.collection.PendingAnalysis) -> app.collection.CompletedAnalysis | None:
-    '''Return the completed analysis if successful, None otherwise.
+def track(pending_analyses: list[app.collection.PendingAnalysis]):
+    '''Have the files of pending analyses staged once they complete. The
+    analyses are recorded in the database for `poll` to check on.'''
+    if not pending_analyses:
+        return
+    now = datetime.datetime.now()
+    app.state.PendingJob.add_many([{
+        'job_id': analysis.job['id'],
+        'job_name': analysis.job['name'],
+        'dir_path': analysis.parent_dir,
+        'state': analysis.job['state'],
+        'interval': app.JOB_POLL_MIN_INTERVAL,
+        'next_check': now + datetime.timedelta(seconds=app.JOB_POLL_MIN_INTERVAL),
+    } for analysis in pending_analyses])
+    POLLER.wake()
+
+def poll():
+    '''
+    Check on the pending jobs which are due to be checked, with one request
+    to SMRT Link for up to `app.smrtlink.JOBS_PER_REQUEST` jobs, and stage
+    the files of those which have completed successfully.
     '''
-    t_start = time.time()
-    while True:
-        job = app.smrtlink.get_job(analysis.id)
-        if not job:
-            app.logger.error(f'Cannot handle job {analysis.id}: Job not found in SMRT Link.')
-            return
-        if job["state"] is SUCCESSFUL:
-            files = app.smrtlink.get_job_files(job['id'])
-            return analysis.complete(files)
-        if job["state"] in FAIL_STATES:
-            return
-        t_current = time.time()
-        if t_current - t_start > MAX_POLLING_TIME:
-            app.logger.error(f"Failed to handle analysis {analysis.id}: Max polling time ({MAX_POLLING_TIME}s) exceeded.")
-            return
-        time.sleep(POLL_RATE)
-
-def track(pending_analyses):
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = {executor.submit(_poll, analysis) for analysis in pending_analyses}
-        
-    for future in concurrent.futures.as_completed(futures):
-        analysis = future.result()
-        if analysis is not None:
-            yield analysis
\ No newline at end of file
+    due = {}
+    for pending_job in app.state.PendingJob.get_due():
+        due.setdefault(pending_job.job_id, []).append(pending_job)
+    if not due:
+        return
+    jobs = app.smrtlink.get_jobs(list(due))
+    successful = [job for job in jobs.values() if job['state'] == SUCCESSFUL]
+    completed = _get_completed(successful, {job['id']: [p.dir_path for p in due[job['id']]]
+                                            for job in successful})
+    now = datetime.datetime.now()
+    finished = []
+    for job_id, pending_jobs in due.items():
+        job = jobs.get(job_id)
+        if job is None:
+            app.logger.error(f'Cannot handle job {job_id}: Job not found in SMRT Link.')
+        elif job['state'] == SUCCESSFUL:
+            if isinstance(completed[job_id], Exception):
+                app.logger.error(f'Failed to get files of job {job_id}: {completed[job_id]}')
+                _reschedule(pending_jobs, job['state'], now) # try again at the next check
+                continue
+            app.filesystem.stage_many(completed[job_id])
+        elif job['state'] in FAIL_STATES:
+            pass
+        elif (now - pending_jobs[0].added).total_seconds() > MAX_POLLING_TIME:
+            app.logger.error(f"Failed to handle analysis {job_id}: Max polling time ({MAX_POLLING_TIME}s) exceeded.")
+        else:
+            _reschedule(pending_jobs, job['state'], now)
+            continue
+        finished += pending_jobs
+    with app.state.transaction():
+        app.state.PendingJob.remove(finished)
+        app.state.DatasetJob.update_states({pending_job.job_id: jobs[pending_job.job_id]['state']
+                                            for pending_job in finished if pending_job.job_id in jobs})
+
+class Poller:
+    '''
+    A thread which runs `poll` whenever a pending job is due to be checked,
+    so that any number of pending jobs are checked on by a single thread.
+    '''
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wake(self):
+        '''Have the poller look for due jobs again, e.g. after jobs are added.'''
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping:
+            timeout = app.JOB_POLL_MAX_INTERVAL
+            try:
+                with app.state.connection():
+                    poll()
+                    next_check = app.state.PendingJob.next_check_time()
+                if next_check is not None:
+                    seconds = (next_check - datetime.datetime.now()).total_seconds()
+                    timeout = min(max(seconds, 0), app.JOB_POLL_MAX_INTERVAL)
+            except Exception as e:
+                app.logger.error(f'Failed to check on pending analysis jobs: {e}')
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+POLLER = Poller()
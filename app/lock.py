@@ -0,0 +1,105 @@
+'''
+Locks which serialize work on the same project or dataset while letting
+work on different projects and datasets run in parallel.
+
+To avoid deadlock, a thread which holds a dataset lock must not acquire
+a project lock; i.e. always lock the project before its datasets. Likewise,
+`NEW_PROJECTS` is acquired before `PERMISSIONS`, and `PERMISSIONS` before
+any project lock.
+'''
+import contextlib
+import threading
+
+class KeyedLock:
+    '''
+    A set of reentrant locks, one per key. A key's lock only exists while
+    some thread holds or is waiting for it, so the set does not grow with
+    the number of keys ever used.
+    '''
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locks = {} # key -> [lock, number of threads holding or waiting]
+
+    def _checkout(self, key) -> threading.RLock:
+        with self._mutex:
+            entry = self._locks.setdefault(key, [threading.RLock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self, key):
+        with self._mutex:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        with self._mutex:
+            return len(self._locks)
+
+    @contextlib.contextmanager
+    def __call__(self, *keys):
+        '''Hold the locks of all of `keys` for the duration of the context.
+        Locks are acquired in a consistent order so that threads locking
+        overlapping sets of keys cannot deadlock.'''
+        keys = sorted(set(keys), key=str)
+        acquired = []
+        try:
+            for key in keys:
+                lock = self._checkout(key)
+                try:
+                    lock.acquire()
+                except BaseException:
+                    self._checkin(key)
+                    raise
+                acquired.append((key, lock))
+            yield
+        finally:
+            for key, lock in reversed(acquired):
+                lock.release()
+                self._checkin(key)
+
+class SharedLock:
+    '''
+    A lock which many threads can hold at once in shared mode, or one
+    thread alone in exclusive mode. Threads waiting for exclusive mode go
+    first, so they are not held off indefinitely. Neither mode is reentrant.
+    '''
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._shared = 0 # number of threads holding the lock in shared mode
+        self._exclusive = False
+        self._waiting = 0 # number of threads waiting for exclusive mode
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._condition:
+            self._condition.wait_for(lambda: not self._exclusive and not self._waiting)
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._shared -= 1
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._condition:
+            self._waiting += 1
+            try:
+                self._condition.wait_for(lambda: not self._exclusive and not self._shared)
+            finally:
+                self._waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+PROJECTS = KeyedLock() # keyed by SMRT Link project ID
+DATASETS = KeyedLock() # keyed by SMRT Link dataset UUID
+NEW_PROJECTS = threading.Lock() # held while finding and handling new projects
+PERMISSIONS = SharedLock() # shared by project handlers, held exclusively while reconciling permissions
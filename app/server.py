@@ -1,10 +1,13 @@
 import http.server
-import time
 import re
 
-import app.handle
+import app.worker
+import app.job
+import app.smrtlink
 import app
 
+EVENT_DELAY = 1 # seconds to give SMRT Link before acting on a notification
+
 def _get_project_id(uri):
     '''Try to get project ID from URI, return None if not found'''
     match = re.match(r'/smrt-link/projects/(\d+)', uri)
@@ -15,7 +18,8 @@ def _get_project_id(uri):
    
 class RequestHandler(http.server.BaseHTTPRequestHandler):
     '''
-    Respond to and log requests, then handle them asynchronously
+    Queue, respond to and log requests. Queued requests are handled
+    asynchronously by the server's workers.
     '''
     def _log_request(self, response_code):
         '''Log the request. Due for a re-design next time a new type of request
@@ -37,6 +41,8 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
                 app.logger.info(f'Received request: {self.command} {self.path}')
         elif response_code == 405:
             app.logger.info(f'Received request concerning project 1, which is not supported.')
+        elif response_code == 500:
+            app.logger.info(f'Received request which could not be queued: {self.command} {self.path}')
         else:
             app.logger.info(f'Received invalid request: {self.command} {self.path}')
     
@@ -64,14 +70,20 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             else:
                 return 404
             
-    def handle_response(self):
+    def handle_response(self, kind, delay=0, coalesce=False):
+        '''Queue the request as an event of the given kind, then respond.
+        The request is only acknowledged once its event is in the database,
+        so that it is not lost if the app restarts.'''
         response_code = self._get_response_code()
+        if response_code == 200:
+            try:
+                self.server.workers.enqueue(kind, self.project_id, delay, coalesce)
+            except Exception as e:
+                app.logger.error(f'Failed to queue {kind} event: {e}')
+                response_code = 500
         self.send_response(response_code) # RESPOND to client/proxy
         self.end_headers()
         self._log_request(response_code) # LOG the request
-        if response_code != 200:
-            return False
-        return True
     
     def parse_request(self) -> bool:
         '''
@@ -85,37 +97,39 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         return request_is_valid
     
     def do_PUT(self):
-        app.handle.expired_permissions()
-        if not self.handle_response():
-            return
-        time.sleep(1)
-        app.handle.updated_project(self.project_id)        
+        self.handle_response(app.worker.UPDATED_PROJECT, app.UPDATE_WINDOW, coalesce=True)
     
     def do_POST(self):
-        app.handle.expired_permissions()
-        if not self.handle_response():
-            return
-        time.sleep(1)
         if self.path == '/smrt-link/projects':
-            app.handle.new_project()
+            kind = app.worker.NEW_PROJECT
         elif self.path == '/smrt-link/job-manager/jobs/analysis':
-            app.handle.new_analyses()
+            kind = app.worker.NEW_ANALYSES
         else:
-            app.logger.error(f'Unexpected POST request: {self.path}')
+            kind = None # not found
+        self.handle_response(kind, EVENT_DELAY)
         
     def do_DELETE(self):
-        app.handle.expired_permissions()
-        if not self.handle_response():
-            return
-        app.handle.deleted_project(self.project_id)
+        self.handle_response(app.worker.DELETED_PROJECT)
 
 class App(http.server.ThreadingHTTPServer):
 
     def __init__(self, server_address):
         super().__init__(server_address, RequestHandler)
+        self.workers = app.worker.Workers(app.WORKER_COUNT)
 
     def run(self):
+        self.workers.start()
+        app.job.POLLER.start()
+        self.workers.enqueue(app.worker.NEW_ANALYSES, coalesce=True) # catch up with jobs created while stopped
+        if app.ACL_RECONCILE_HOURS > 0:
+            self.workers.schedule(app.worker.RECONCILE_PERMISSIONS, app.ACL_RECONCILE_HOURS * 3600)
+        if app.PERMISSION_SWEEP_HOURS > 0:
+            self.workers.schedule(app.worker.SWEEP_PERMISSIONS, app.PERMISSION_SWEEP_HOURS * 3600)
         self.serve_forever()
 
     def stop(self):
-        self.shutdown()
\ No newline at end of file
+        self.shutdown()
+        self.workers.stop()
+        app.job.POLLER.stop()
+        if app.smrtlink.CLIENT is not None:
+            app.logger.info(f'SMRT Link response cache: {app.smrtlink.CLIENT.cache.stats()}')
\ No newline at end of file
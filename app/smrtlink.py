@@ -1,3 +1,10 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+import typing
 import urllib3
 
 import app.smrtlink_client
@@ -5,8 +12,118 @@ import app
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+class ResponseCache:
+    '''
+    A cache of SMRT Link responses which never change, holding at most
+    `max_size` of them and evicting the least recently used when full. If a
+    `path` is given, responses are also appended to that file as they are
+    cached, and loaded from it again when the app restarts. The file is
+    rewritten with just the cached responses whenever it holds more than
+    `COMPACT_FACTOR` times `max_size` of them, so it does not grow without
+    bound.
+    '''
+    COMPACT_FACTOR = 2
+
+    def __init__(self, max_size: int, path: str = None):
+        self._max_size = max_size
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # key -> response, least recently used first
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lines = 0 # responses in the file, including evicted ones
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        '''Load the responses saved in the file, then rewrite it with just
+        those which fit in the cache.'''
+        if os.path.exists(self._path):
+            with open(self._path) as f:
+                for line in f:
+                    try:
+                        key, response = json.loads(line)
+                    except ValueError: # e.g. a line cut short when the app stopped
+                        continue
+                    self._add(key, response)
+        self._compact()
+
+    def _compact(self):
+        '''Rewrite the file with just the responses in the cache.'''
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as f:
+            for key, response in self._entries.items():
+                f.write(json.dumps([key, response]) + '\n')
+        os.replace(temp_path, self._path)
+        self._lines = len(self._entries)
+
+    def _add(self, key: str, response):
+        self._entries[key] = response
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._evictions += 1
+
+    def get(self, key: str):
+        '''Returns the cached response, or None if there is none.'''
+        with self._lock:
+            if key in self._entries:
+                self._hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self._misses += 1
+            return None
+
+    def put(self, key: str, response):
+        if self._max_size <= 0:
+            return
+        with self._lock:
+            self._add(key, response)
+            if self._path is not None:
+                with open(self._path, 'a') as f:
+                    f.write(json.dumps([key, response]) + '\n')
+                self._lines += 1
+                if self._lines > self.COMPACT_FACTOR * self._max_size:
+                    self._compact()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'size': len(self._entries),
+            }
+
 class DnascSmrtLinkClient(app.smrtlink_client.SmrtLinkClient):
 
+    def __init__(self, *args, cache: ResponseCache = None, **kwds):
+        super().__init__(*args, **kwds)
+        self.cache = cache if cache is not None else ResponseCache(0)
+
+    def _get_cached(self, path):
+        '''GET a response which never changes, from the cache if possible.'''
+        response = self.cache.get(path)
+        if response is None:
+            response = self.get(path)
+            self.cache.put(path, response)
+        return response
+
+    def get_job_entry_points(self, job_id):
+        '''
+        Get the datasets used to create a job. These are fixed when the job
+        is created, so are cached.
+        '''
+        return self._get_cached(f"{self.JOBS_PATH}/analysis/{job_id}/entry-points")
+
+    def get_finished_job_datastore(self, job_id):
+        '''
+        Like `get_job_datastore`, for a job which has finished. The datastore
+        of a finished job does not change, so is cached.
+        '''
+        return self._get_cached(f"{self.JOBS_PATH}/analysis/{job_id}/datastore")
+
     def get_project_dict(self, id):
         '''
         Returns a dictionary of project data, or None if not found.
@@ -32,7 +149,11 @@ def _get_smrtlink_client():
             port=app.SMRTLINK_PORT,
             username=app.SMRTLINK_USER,
             password=app.SMRTLINK_PASS,
-            verify=False # Disable SSL verification
+            verify=False, # Disable SSL verification
+            pool_size=app.SMRTLINK_POOL_SIZE,
+            retries=app.SMRTLINK_RETRIES,
+            timeout=app.SMRTLINK_TIMEOUT,
+            cache=ResponseCache(app.SMRTLINK_CACHE_SIZE, app.SMRTLINK_CACHE_PATH)
         )
     except Exception as e:
         app.logger.error(f'Error initializing SMRT Link client: {e}')
@@ -41,43 +162,104 @@ CLIENT = _get_smrtlink_client()
 
 def get_jobs_created_after(time):
     '''
-    Get jobs from SMRT Link created after `time` and belonging
-    to a project other than project 1.
+    Get jobs from SMRT Link created after `time`. Jobs in project 1 are
+    included, although they are not staged, since they are indexed in
+    `app.state.DatasetJob` along with the rest (see `app.job.sync`).
 
     `time`: a timestamp in the format 'YYYY-MM-DDTHH:MM:SS.sssZ'.
     '''
-    return CLIENT.get_analysis_jobs(createdAt='gt:' + time,
-                                    projectId='not:1')
+    return CLIENT.get_analysis_jobs(createdAt='gt:' + time)
 
-def get_job_datasets(id):
-    '''Get datasets for a job by id from SMRT Link.'''
-    return CLIENT.get_job_datasets(id)
+def get_job_datasets(id) -> list[str]:
+    '''Get the UUIDs of the datasets used by a job from SMRT Link.'''
+    return [entry_point['datasetUUID'] for entry_point in CLIENT.get_job_datasets(id)]
 
 def get_job(id):
     '''Get a job by id from SMRT Link.'''
     return CLIENT.get_job(id)
 
+JOBS_PER_REQUEST = 100 # max. job IDs in one search, to keep the URL short
+
+def get_jobs(ids: list[int]) -> dict[int, dict]:
+    '''Get jobs by id from SMRT Link, with one search per `JOBS_PER_REQUEST`
+    jobs. Jobs which are not found are left out of the result.'''
+    jobs = {}
+    for i in range(0, len(ids), JOBS_PER_REQUEST):
+        id_list = ','.join(str(id) for id in ids[i:i + JOBS_PER_REQUEST])
+        jobs.update((job['id'], job) for job in CLIENT.get_analysis_jobs(id='in:' + id_list))
+    return jobs
+
 def get_dataset_jobs(id):
     '''Get jobs for a dataset by id from SMRT Link.'''
     return CLIENT.get_dataset_jobs(id)
 
-def get_job_files(id):
-    '''Get files for a job by id from SMRT Link.'''
-    return CLIENT.get_job_datastore(id)
+def get_job_files(id) -> list[str]:
+    '''Get the paths of the files output by a job which has finished from
+    SMRT Link.'''
+    return [file['path'] for file in CLIENT.get_finished_job_datastore(id)]
+
+def _fetch_many(fetch, ids: list) -> dict:
+    '''Call `fetch` for each of `ids` concurrently, over the client's pool of
+    connections to SMRT Link. Returns a dict of each id to the result, or to
+    the exception raised when fetching it, so that one failure does not
+    affect the other ids.'''
+    ids = list(dict.fromkeys(ids))
+    if not ids:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(app.SMRTLINK_POOL_SIZE, len(ids))) as executor:
+        futures = {id: executor.submit(fetch, id) for id in ids}
+    return {id: future.exception() or future.result() for id, future in futures.items()}
+
+def get_jobs_datasets(ids: list[int]) -> dict:
+    '''Like `get_job_datasets`, for many jobs at once (see `_fetch_many`).'''
+    return _fetch_many(get_job_datasets, ids)
+
+def get_jobs_files(ids: list[int]) -> dict:
+    '''Like `get_job_files`, for many jobs at once (see `_fetch_many`).'''
+    return _fetch_many(get_job_files, ids)
 
 def _get_member_ids(member_data) -> list[str]:
     return [member['login'] for member in member_data 
             if member['role'] != 'OWNER']
 
+def datasets_fingerprint(dataset_dicts: list[dict]) -> str:
+    '''A hash of the UUIDs of a project's datasets, which changes when a
+    dataset is added to or removed from the project.'''
+    uuids = sorted(dataset_d['uuid'] for dataset_d in dataset_dicts)
+    return hashlib.sha256('\n'.join(uuids).encode()).hexdigest()
+
 def get_project(id) -> tuple[list[dict], list[str]]:
     '''Raises Exception'''
     project_d = CLIENT.get_project_dict(id)
+    if project_d is None:
+        raise Exception(f'Project {id} not found in SMRT Link')
     member_ids = _get_member_ids(project_d['members'])
     return project_d['datasets'], member_ids
 
-def get_new_project() -> tuple[int, list[dict], list[str]]:
-    '''Raises Exception'''
-    sl_ids = CLIENT.get_project_ids()
-    project_d = CLIENT.get_project_dict(sl_ids[-1])
-    member_ids = _get_member_ids(project_d['members'])
-    return project_d['id'], project_d['datasets'], member_ids
\ No newline at end of file
+MAX_MISSING_PROJECTS = 3 # consecutive project IDs not found, e.g. of deleted projects, before probing stops
+
+def get_new_projects(last_id: typing.Union[int, None]) -> typing.Iterator[tuple[int, list[dict], list[str]]]:
+    '''
+    Get the ID, datasets and members of each project created after project
+    `last_id`, in the order they were created. SMRT Link numbers projects in
+    the order they are created, so the IDs after `last_id` are tried in turn
+    rather than listing every project, stopping after `MAX_MISSING_PROJECTS`
+    IDs in a row are not found. If `last_id` is None, only the latest
+    project is got.
+
+    Raises Exception
+    '''
+    if last_id is None:
+        latest_id = max(CLIENT.get_project_ids(), default=None)
+        if latest_id is None:
+            return
+        last_id = latest_id - 1
+    id, missing = last_id + 1, 0
+    while missing < MAX_MISSING_PROJECTS:
+        project_d = CLIENT.get_project_dict(id)
+        if project_d is None:
+            missing += 1
+        else:
+            missing = 0
+            yield project_d['id'], project_d['datasets'], _get_member_ids(project_d['members'])
+        id += 1
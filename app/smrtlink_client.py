@@ -154,12 +154,15 @@ import urllib.parse
 import argparse
 import logging
 import json
+import threading
 import time
 import os
 import sys
 
 # This is the only non-standard dependency
 import requests
+import requests.adapters
+from urllib3.util.retry import Retry
 
 __all__ = [
     "SmrtLinkClient",
@@ -176,6 +179,11 @@ class Constants:
     H_CT_JSON = "application/json"
     # SSL is good and we should not disable it by default
     DEFAULT_VERIFY = True
+    # Connection pooling and retry defaults (see RESTClient)
+    DEFAULT_POOL_SIZE = 10
+    DEFAULT_RETRIES = 3
+    DEFAULT_BACKOFF_FACTOR = 0.5
+    DEFAULT_TIMEOUT = 60
 
 
 def refresh_on_401(f):
@@ -217,10 +225,68 @@ class RESTClient(ABC):
     """
     PROTOCOL = "http"
 
-    def __init__(self, host, port, verify=Constants.DEFAULT_VERIFY):
+    def __init__(self, host, port, verify=Constants.DEFAULT_VERIFY,
+                 pool_size=Constants.DEFAULT_POOL_SIZE,
+                 retries=Constants.DEFAULT_RETRIES,
+                 backoff_factor=Constants.DEFAULT_BACKOFF_FACTOR,
+                 timeout=Constants.DEFAULT_TIMEOUT):
         self.host = host
         self.port = port
         self._verify = verify
+        self._timeout = timeout
+        # All threads share one adapter, and therefore one pool of kept-alive
+        # connections.  Retries apply only to failures to connect, since
+        # the request has not reached the server in that case.
+        self._adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=Retry(total=retries,
+                              connect=retries,
+                              read=0,
+                              status=0,
+                              backoff_factor=backoff_factor,
+                              raise_on_status=False))
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """
+        The calling thread's requests.Session.  Sessions are not safe to
+        share between threads, so each thread gets its own, but all of them
+        are mounted on the same pooled adapter.
+        """
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.verify = self._verify
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+            self._local.session = session
+        return session
+
+    def close(self):
+        """Close all pooled connections"""
+        self._adapter.close()
+
+    def connection_stats(self):
+        """
+        Return a dict with the number of requests sent and the number of
+        connections opened by this client.  Every request beyond the number
+        of connections was sent over a reused (kept-alive) connection.
+        """
+        pools = self._adapter.poolmanager.pools
+        pools = [pools.get(key) for key in pools.keys()]
+        pools = [pool for pool in pools if pool is not None]
+        n_requests = sum(pool.num_requests for pool in pools)
+        n_connections = sum(pool.num_connections for pool in pools)
+        return {
+            "requests": n_requests,
+            "connections": n_connections,
+            "reused": max(n_requests - n_connections, 0)
+        }
+
+    def _get_timeout(self, timeout):
+        return self._timeout if timeout is None else timeout
 
     @abstractmethod
     def refresh(self):
@@ -245,7 +311,7 @@ class RESTClient(ABC):
         return headers
 
     @refresh_on_401
-    def _http_get(self, path, params=None, headers={}):
+    def _http_get(self, path, params=None, headers={}, timeout=None):
         if isinstance(params, dict):
             if len(params) == 0:
                 params = None
@@ -255,79 +321,84 @@ class RESTClient(ABC):
         url = self.to_url(path)
         log.info(f"Method: GET {path}")
         log.debug(f"Full URL: {url}")
-        response = requests.get(url,
-                                params=params,
-                                headers=self._get_headers(headers),
-                                verify=self._verify)
+        response = self.session.get(url,
+                                    params=params,
+                                    headers=self._get_headers(headers),
+                                    verify=self._verify,
+                                    timeout=self._get_timeout(timeout))
         log.debug(response)
         response.raise_for_status()
         return response
 
     @refresh_on_401
-    def _http_post(self, path, data, headers={}):
+    def _http_post(self, path, data, headers={}, timeout=None):
         url = self.to_url(path)
         log.info(f"Method: POST {path} {data}")
         log.debug(f"Full URL: {url}")
-        response = requests.post(url,
-                                 data=json.dumps(data),
-                                 headers=self._get_headers(headers),
-                                 verify=self._verify)
+        response = self.session.post(url,
+                                     data=json.dumps(data),
+                                     headers=self._get_headers(headers),
+                                     verify=self._verify,
+                                     timeout=self._get_timeout(timeout))
         log.debug(response)
         response.raise_for_status()
         return response
 
     @refresh_on_401
-    def _http_put(self, path, data, headers={}):
+    def _http_put(self, path, data, headers={}, timeout=None):
         url = self.to_url(path)
         log.info(f"Method: PUT {path} {data}")
         log.debug(f"Full URL: {url}")
-        response = requests.put(url,
-                                data=json.dumps(data),
-                                headers=self._get_headers(headers),
-                                verify=self._verify)
+        response = self.session.put(url,
+                                    data=json.dumps(data),
+                                    headers=self._get_headers(headers),
+                                    verify=self._verify,
+                                    timeout=self._get_timeout(timeout))
         log.debug(response)
         response.raise_for_status()
         return response
 
     @refresh_on_401
-    def _http_delete(self, path, headers={}):
+    def _http_delete(self, path, headers={}, timeout=None):
         url = self.to_url(path)
         log.info(f"Method: DELETE {path}")
         log.debug(f"Full URL: {url}")
-        response = requests.delete(url,
-                                   headers=self._get_headers(headers),
-                                   verify=self._verify)
+        response = self.session.delete(url,
+                                       headers=self._get_headers(headers),
+                                       verify=self._verify,
+                                       timeout=self._get_timeout(timeout))
         log.debug(response)
         response.raise_for_status()
         return response
 
     @refresh_on_401
-    def _http_options(self, path, headers={}):
+    def _http_options(self, path, headers={}, timeout=None):
         url = self.to_url(path)
         log.info(f"Method: OPTIONS {url}")
         log.debug(f"Full URL: {url}")
-        response = requests.options(url,
-                                    headers=self._get_headers(headers),
-                                    verify=self._verify)
+        response = self.session.options(url,
+                                        headers=self._get_headers(headers),
+                                        verify=self._verify,
+                                        timeout=self._get_timeout(timeout))
         log.debug(response)
         response.raise_for_status()
         return response
 
-    def get(self, path, params=None, headers={}):
+    def get(self, path, params=None, headers={}, timeout=None):
         """Generic JSON GET method handler"""
-        return self._http_get(path, params, headers).json()
+        return self._http_get(path, params, headers, timeout).json()
 
-    def post(self, path, data, headers={}):
+    def post(self, path, data, headers={}, timeout=None):
         """Generic JSON POST method handler"""
-        return self._http_post(path, data, headers).json()
+        return self._http_post(path, data, headers, timeout).json()
 
-    def put(self, path, data, headers={}):
+    def put(self, path, data, headers={}, timeout=None):
         """Generic JSON PUT method handler"""
-        return self._http_put(path, data, headers).json()
+        return self._http_put(path, data, headers, timeout).json()
 
-    def delete(self, path, headers={}):
+    def delete(self, path, headers={}, timeout=None):
         """Generic JSON DELETE method handler"""
-        return self._http_delete(path, headers).json()
+        return self._http_delete(path, headers, timeout).json()
 
     def options(self, path, headers={}):
         """
@@ -360,8 +431,8 @@ class AuthenticatedClient(RESTClient):
     """
 
     def __init__(self, host, port, username, password,
-                 verify=Constants.DEFAULT_VERIFY):
-        super(AuthenticatedClient, self).__init__(host, port, verify)
+                 verify=Constants.DEFAULT_VERIFY, **kwds):
+        super(AuthenticatedClient, self).__init__(host, port, verify, **kwds)
         self._user = username
         self._oauth2 = self.get_authorization_token(username, password)
 
@@ -400,16 +471,19 @@ class SmrtLinkClient(AuthenticatedClient):
         super(SmrtLinkClient, self).__init__(*args, **kwds)
 
     @staticmethod
-    def connect(host, username, password, verify=Constants.DEFAULT_VERIFY):
+    def connect(host, username, password, verify=Constants.DEFAULT_VERIFY,
+                **kwds):
         """
         Convenience method for instantiating a client using the default
-        API port 8243
+        API port 8243.  Additional keyword arguments (pool_size, retries,
+        backoff_factor, timeout) configure the connection pool.
         """
         return SmrtLinkClient(host=host,
                               port=Constants.API_PORT,
                               username=username,
                               password=password,
-                              verify=verify)
+                              verify=verify,
+                              **kwds)
 
     @property
     def headers(self):
@@ -432,10 +506,11 @@ class SmrtLinkClient(AuthenticatedClient):
         auth_d = dict(username=username,
                       password=password,
                       grant_type="password")
-        resp = requests.post(f"{self.base_url}/token",
-                             data=auth_d,
-                             headers={"Content-Type": Constants.H_CT_AUTH},
-                             verify=self._verify)
+        resp = self.session.post(f"{self.base_url}/token",
+                                 data=auth_d,
+                                 headers={"Content-Type": Constants.H_CT_AUTH},
+                                 verify=self._verify,
+                                 timeout=self._timeout)
         resp.raise_for_status()
         t = resp.json()
         log.info("Access token: {}...".format(t["access_token"][0:40]))
@@ -450,10 +525,11 @@ class SmrtLinkClient(AuthenticatedClient):
         log.info("Requesting new access token using refresh token")
         auth_d = dict(grant_type="refresh_token",
                       refresh_token=self.refresh_token)
-        resp = requests.post(self.to_url("/token"),
-                             data=auth_d,
-                             headers={"Content-Type": Constants.H_CT_AUTH},
-                             verify=self._verify)
+        resp = self.session.post(self.to_url("/token"),
+                                 data=auth_d,
+                                 headers={"Content-Type": Constants.H_CT_AUTH},
+                                 verify=self._verify,
+                                 timeout=self._timeout)
         resp.raise_for_status()
         t = resp.json()
         log.info("Access token: {}...".format(t["access_token"][0:40]))
@@ -1094,10 +1170,11 @@ class SmrtLinkClient(AuthenticatedClient):
         headers = {
             "Authorization": f"Bearer {self.auth_token}"
         }
-        response = requests.post(url,
-                                 files=files_d,
-                                 headers=headers,
-                                 verify=self._verify)
+        response = self.session.post(url,
+                                     files=files_d,
+                                     headers=headers,
+                                     verify=self._verify,
+                                     timeout=self._timeout)
         log.debug(response)
         response.raise_for_status()
         return response.json()
@@ -1,13 +1,57 @@
 import datetime
+import sqlite3
 import typing
+import os
 import peewee
 import app
 
+PRAGMAS = {
+    'journal_mode': 'wal', # readers do not block the writer, nor the writer readers
+    'synchronous': 'normal', # safe with WAL, and avoids an fsync per transaction
+    'cache_size': -64 * 1024, # KiB, i.e. 64 MiB
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+# Each thread has its own connection to the database (see `connection`). Every
+# connection to ':memory:' would open a separate, empty database, so instead
+# connections share a named in-memory database, which `_keepalive` keeps in
+# existence while no other connection is open.
+MEMORY_URI = f'file:smrtlink-share-{os.getpid()}?mode=memory&cache=shared'
+_keepalive = None
+
 try:
-    db = peewee.SqliteDatabase(app.DB_PATH)
+    if app.DB_PATH == ':memory:':
+        _keepalive = sqlite3.connect(MEMORY_URI, uri=True, check_same_thread=False)
+        db = peewee.SqliteDatabase(MEMORY_URI, pragmas=PRAGMAS, timeout=app.DB_BUSY_TIMEOUT, uri=True)
+    else:
+        # `timeout` sets SQLite's busy timeout: how long to wait for another connection's write
+        db = peewee.SqliteDatabase(app.DB_PATH, pragmas=PRAGMAS, timeout=app.DB_BUSY_TIMEOUT)
 except Exception as e:
     raise ImportError(f"Failed to initialize database: {e}")
 
+def connection():
+    '''Open a connection for the current thread for the duration of a unit of
+    work, such as handling an event, and close it afterwards. Nested uses
+    share the connection.'''
+    return db.connection_context()
+
+def transaction():
+    '''Begin a transaction in which to write. SQLite's write lock is taken at
+    the start of the transaction (BEGIN IMMEDIATE) so that, when another
+    connection is writing, the transaction waits for the busy timeout rather
+    than failing with "database is locked" when it first writes.'''
+    return db.atomic('IMMEDIATE')
+
+MAX_VARIABLES = 500 # max. values bound in one query; SQLite's limit can be as low as 999
+
+def _case_update(model, field, key_field, values: dict):
+    '''Set `field` of each row whose `key_field` is a key of `values` to the
+    corresponding value, using one UPDATE ... CASE query per chunk of rows.'''
+    keys = list(values)
+    for chunk in peewee.chunked(keys, MAX_VARIABLES // 3):
+        case = peewee.Case(key_field, [(key, values[key]) for key in chunk])
+        model.update({field: case}).where(key_field.in_(chunk)).execute()
+
 class BaseMeta(peewee.Model.__class__, app.BaseDataset.__class__):
     '''Using this metaclass prevents a metaclass conflict which would prevent
     a class like app.state.Dataset from inheriting from both peewee.Model 
@@ -28,13 +72,38 @@ class Dataset(peewee.Model, app.BaseDataset, metaclass=BaseMeta):
     also needed when an analysis completes and the file results are to be staged.'''
     uuid = peewee.CharField(primary_key=True, 
                         max_length=36)
-    project_id = peewee.IntegerField()
+    project_id = peewee.IntegerField(index=True)
     dir_path = peewee.CharField()
 
     @staticmethod
     def get_by_dataset_uuid(uuid: str) -> typing.Union['Dataset', None]:
         return Dataset.get_or_none(Dataset.uuid == uuid)
     
+    @staticmethod
+    def get_by_uuids(uuids: list[str]) -> dict[str, 'Dataset']:
+        '''Get the datasets with any of `uuids`, by uuid.'''
+        datasets = {}
+        for chunk in peewee.chunked(uuids, MAX_VARIABLES):
+            datasets.update((dataset.uuid, dataset) for dataset in
+                            Dataset.select().where(Dataset.uuid.in_(chunk)))
+        return datasets
+
+    @staticmethod
+    def add_many(rows: list[dict]):
+        '''Insert a row for each dict of `uuid`, `project_id` and `dir_path`.'''
+        for chunk in peewee.chunked(rows, MAX_VARIABLES // 3):
+            Dataset.insert_many(chunk).execute()
+
+    @staticmethod
+    def update_project_ids(project_ids: dict[str, int]):
+        '''Set the project ID of each dataset, given by uuid.'''
+        _case_update(Dataset, Dataset.project_id, Dataset.uuid, project_ids)
+
+    @staticmethod
+    def update_dir_paths(dir_paths: dict[str, str]):
+        '''Set the directory path of each dataset, given by uuid.'''
+        _case_update(Dataset, Dataset.dir_path, Dataset.uuid, dir_paths)
+
     @staticmethod
     def get_by_project_id(project_id: int) -> list['Dataset']:
         return (Dataset.select()
@@ -54,10 +123,17 @@ class Dataset(peewee.Model, app.BaseDataset, metaclass=BaseMeta):
         self.project_id = project_id
         self.save()
 
+    def update_dir_path(self, dir_path: str):
+        self.dir_path = dir_path
+        self.save()
+
 class ProjectMember(peewee.Model):
     project_id = peewee.IntegerField()
     member_id = peewee.CharField()
 
+    class Meta:
+        indexes = ((('project_id', 'member_id'), True),)
+
     @staticmethod
     def exists(project_id: int, member_id: str) -> bool:
         return (ProjectMember.select()
@@ -65,6 +141,22 @@ class ProjectMember(peewee.Model):
                                    ProjectMember.member_id == member_id)
                             .exists())
 
+    @staticmethod
+    def get_member_ids(project_id: int) -> set[str]:
+        return {member.member_id for member in
+                ProjectMember.select(ProjectMember.member_id)
+                             .where(ProjectMember.project_id == project_id)}
+
+    @staticmethod
+    def add_many(project_id: int, member_ids: list[str]):
+        rows = [{'project_id': project_id, 'member_id': member_id} for member_id in member_ids]
+        for chunk in peewee.chunked(rows, MAX_VARIABLES // 2):
+            ProjectMember.insert_many(chunk).execute()
+
+    @staticmethod
+    def remove_project(project_id: int):
+        ProjectMember.delete().where(ProjectMember.project_id == project_id).execute()
+
     @staticmethod
     def get_removed_members(project_id: int, current_members: list[str]) -> list['ProjectMember']:
         return (ProjectMember
@@ -73,11 +165,37 @@ class ProjectMember(peewee.Model):
                        ProjectMember.member_id.not_in(current_members))
                 .execute())
 
+class ProjectDatasets(peewee.Model):
+    '''
+    A fingerprint of the datasets of a project (see
+    `app.smrtlink.datasets_fingerprint`) as of the last time all of them
+    were handled, so that an update to a project which leaves its datasets
+    unchanged need only handle its members.
+    '''
+    project_id = peewee.IntegerField(primary_key=True)
+    fingerprint = peewee.CharField()
+
+    @staticmethod
+    def get_fingerprint(project_id: int) -> typing.Union[str, None]:
+        row = ProjectDatasets.get_or_none(ProjectDatasets.project_id == project_id)
+        return row.fingerprint if row is not None else None
+
+    @staticmethod
+    def set_fingerprint(project_id: int, fingerprint: str):
+        ProjectDatasets.insert(project_id=project_id, fingerprint=fingerprint).on_conflict_replace().execute()
+
+    @staticmethod
+    def remove_project(project_id: int):
+        ProjectDatasets.delete().where(ProjectDatasets.project_id == project_id).execute()
+
 class Permission(peewee.Model):
     id = peewee.CharField(primary_key=True)
     member_id = peewee.CharField()
     dataset_uuid = peewee.CharField()
-    expiry = peewee.DateTimeField()
+    expiry = peewee.DateTimeField(index=True)
+
+    class Meta:
+        indexes = ((('dataset_uuid', 'member_id'), False),)
 
     @staticmethod
     def get_by(member_id: str, dataset_id: str) -> typing.Union['Permission', None]:
@@ -89,6 +207,17 @@ class Permission(peewee.Model):
         return (Permission.select()
                           .where(Permission.dataset_uuid == dataset_id)
                           .execute())
+
+    @staticmethod
+    def get_by_members(member_ids: list[str], dataset_ids: list[str]) -> list['Permission']:
+        '''Get the permissions of any of `member_ids` to access any of `dataset_ids`.'''
+        permissions = []
+        for member_chunk in peewee.chunked(member_ids, MAX_VARIABLES // 2):
+            for dataset_chunk in peewee.chunked(dataset_ids, MAX_VARIABLES // 2):
+                permissions.extend(Permission.select()
+                                             .where(Permission.member_id.in_(member_chunk),
+                                                    Permission.dataset_uuid.in_(dataset_chunk)))
+        return permissions
     
     @staticmethod
     def remove_expired():
@@ -97,11 +226,80 @@ class Permission(peewee.Model):
                     .where(Permission.expiry < now)
                     .execute())
 
+    @staticmethod
+    def get_renewable(before: datetime.datetime) -> list['Permission']:
+        '''Get the unexpired permissions which expire before `before` and
+        whose member is still a member of the dataset's project.'''
+        now = datetime.datetime.now()
+        return (Permission.select()
+                          .join(Dataset, on=(Permission.dataset_uuid == Dataset.uuid))
+                          .join(ProjectMember, on=((ProjectMember.project_id == Dataset.project_id) &
+                                                   (ProjectMember.member_id == Permission.member_id)))
+                          .where(Permission.expiry >= now,
+                                 Permission.expiry < before)
+                          .execute())
+
+    @staticmethod
+    def update_expiry(ids: list[str], expiry: datetime.datetime):
+        Permission.update(expiry=expiry).where(Permission.id.in_(ids)).execute()
+
+class ProjectPermission(peewee.Model):
+    '''A permission for a project member to access the project's whole
+    directory, used instead of `Permission` when `app.PROJECT_DIRECTORIES`
+    is set.'''
+    id = peewee.CharField(primary_key=True)
+    member_id = peewee.CharField()
+    project_id = peewee.IntegerField()
+    expiry = peewee.DateTimeField(index=True)
+
+    class Meta:
+        indexes = ((('project_id', 'member_id'), False),)
+
+    @staticmethod
+    def get_by_project_id(project_id: int, member_ids: list[str] = None) -> list['ProjectPermission']:
+        '''Get the permissions to access the project's directory, optionally
+        only those of `member_ids`.'''
+        query = ProjectPermission.select().where(ProjectPermission.project_id == project_id)
+        if member_ids is not None:
+            query = query.where(ProjectPermission.member_id.in_(member_ids))
+        return query.execute()
+
+    @staticmethod
+    def get_member_ids(project_id: int) -> set[str]:
+        '''Get the IDs of the members who have permission to access the
+        project's directory.'''
+        return {permission.member_id for permission in ProjectPermission.get_by_project_id(project_id)}
+
+    @staticmethod
+    def remove_expired():
+        now = datetime.datetime.now()
+        (ProjectPermission.delete()
+                          .where(ProjectPermission.expiry < now)
+                          .execute())
+
+    @staticmethod
+    def get_renewable(before: datetime.datetime) -> list['ProjectPermission']:
+        '''Get the unexpired permissions which expire before `before` and
+        whose member is still a member of the project.'''
+        now = datetime.datetime.now()
+        return (ProjectPermission.select()
+                                 .join(ProjectMember, on=((ProjectMember.project_id == ProjectPermission.project_id) &
+                                                          (ProjectMember.member_id == ProjectPermission.member_id)))
+                                 .where(ProjectPermission.expiry >= now,
+                                        ProjectPermission.expiry < before)
+                                 .execute())
+
+    @staticmethod
+    def update_expiry(ids: list[str], expiry: datetime.datetime):
+        ProjectPermission.update(expiry=expiry).where(ProjectPermission.id.in_(ids)).execute()
+
 class LastJobUpdate(peewee.Model):
     '''
     A class defining a table with a single row which stores a timestamp.
+    The timestamp is kept as SMRT Link formats it, since it is passed back
+    to SMRT Link as a search parameter.
     '''
-    timestamp = peewee.DateTimeField()
+    timestamp = peewee.CharField()
 
     @staticmethod
     def set(time):
@@ -120,8 +318,330 @@ class LastJobUpdate(peewee.Model):
         '''
         return LastJobUpdate.get_by_id(1).timestamp
 
+class LastProject(peewee.Model):
+    '''
+    A table with a single row which stores the ID of the latest project
+    handled as a new project (see `app.handle.new_project`), or None until
+    the first is.
+    '''
+    project_id = peewee.IntegerField(null=True)
+
+    @staticmethod
+    def set(project_id: int):
+        LastProject.update(project_id=project_id).execute()
+
+    @staticmethod
+    def latest() -> typing.Union[int, None]:
+        return LastProject.get_by_id(1).project_id
+
+class JobRetry(peewee.Model):
+    '''
+    An analysis job which could not be handled when it was synced (see
+    `app.job.sync`), and which is to be tried again once `due`. The delay
+    before each retry is twice the previous one.
+    '''
+    job_id = peewee.IntegerField(primary_key=True)
+    attempts = peewee.IntegerField(default=1)
+    error = peewee.TextField()
+    due = peewee.DateTimeField(index=True)
+
+    FIRST_DELAY = 60 # seconds
+
+    @staticmethod
+    def add_many(errors: dict[int, str]):
+        '''Record the error which prevented each job from being handled.'''
+        due = datetime.datetime.now() + datetime.timedelta(seconds=JobRetry.FIRST_DELAY)
+        rows = [{'job_id': job_id, 'error': error, 'due': due} for job_id, error in errors.items()]
+        for chunk in peewee.chunked(rows, MAX_VARIABLES // 3):
+            JobRetry.insert_many(chunk).on_conflict_replace().execute()
+
+    @staticmethod
+    def get_due(limit: int) -> list['JobRetry']:
+        now = datetime.datetime.now()
+        return list(JobRetry.select()
+                            .where(JobRetry.due <= now)
+                            .order_by(JobRetry.due)
+                            .limit(limit))
+
+    def failed(self, error: str):
+        '''Record another failed attempt.'''
+        self.attempts += 1
+        self.error = error
+        delay = JobRetry.FIRST_DELAY * 2 ** (self.attempts - 1)
+        self.due = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.save()
+
+class ProjectRetry(peewee.Model):
+    '''
+    A new project which could not be handled (see `app.handle.new_project`),
+    and which is to be tried again once `due`. The delay before each retry
+    is twice the previous one.
+    '''
+    project_id = peewee.IntegerField(primary_key=True)
+    attempts = peewee.IntegerField(default=1)
+    error = peewee.TextField()
+    due = peewee.DateTimeField(index=True)
+
+    FIRST_DELAY = 60 # seconds
+
+    @staticmethod
+    def add(project_id: int, error: str):
+        '''Record the error which prevented the project from being handled.'''
+        due = datetime.datetime.now() + datetime.timedelta(seconds=ProjectRetry.FIRST_DELAY)
+        ProjectRetry.replace(project_id=project_id, error=error, due=due).execute()
+
+    @staticmethod
+    def get_due() -> list['ProjectRetry']:
+        now = datetime.datetime.now()
+        return list(ProjectRetry.select()
+                                .where(ProjectRetry.due <= now)
+                                .order_by(ProjectRetry.due))
+
+    def failed(self, error: str):
+        '''Record another failed attempt.'''
+        self.attempts += 1
+        self.error = error
+        delay = ProjectRetry.FIRST_DELAY * 2 ** (self.attempts - 1)
+        self.due = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        self.save()
+
+class DatasetJob(peewee.Model):
+    '''
+    An index of the analysis jobs of each dataset, kept so that the jobs of
+    a dataset can be looked up without asking SMRT Link. Jobs are added as
+    they are synced (see `app.job.sync`); a job of several datasets has a
+    row for each.
+
+    `state`: the job's state when it was last seen.
+    '''
+    dataset_uuid = peewee.CharField()
+    job_id = peewee.IntegerField()
+    job_name = peewee.CharField()
+    state = peewee.CharField()
+
+    class Meta:
+        indexes = ((('dataset_uuid', 'job_id'), True),)
+
+    @staticmethod
+    def add_many(rows: list[dict]):
+        '''Add a row for each dict of `dataset_uuid`, `job_id`, `job_name`
+        and `state`, replacing any row for the same dataset and job.'''
+        for chunk in peewee.chunked(rows, MAX_VARIABLES // 4):
+            DatasetJob.insert_many(chunk).on_conflict_replace().execute()
+
+    @staticmethod
+    def get_by_dataset_uuid(uuid: str) -> list['DatasetJob']:
+        return list(DatasetJob.select().where(DatasetJob.dataset_uuid == uuid))
+
+    @staticmethod
+    def update_states(states: dict[int, str]):
+        '''Set the state of each job by id.'''
+        _case_update(DatasetJob, DatasetJob.state, DatasetJob.job_id, states)
+
+class JobIndexUpdate(peewee.Model):
+    '''
+    A table with a single row which tracks the indexing of jobs in
+    `DatasetJob`. Jobs created since the `LastJobUpdate` at the time the
+    index was added, `until`, are indexed as they are synced; those created
+    before are indexed separately, and `timestamp` is the `createdAt` of the
+    latest of them indexed so far. The index is complete once the two meet
+    and the sync has caught up with SMRT Link, noted by `caught_up`.
+    '''
+    timestamp = peewee.CharField()
+    until = peewee.CharField()
+    caught_up = peewee.BooleanField(default=False)
+
+    @staticmethod
+    def set(time):
+        JobIndexUpdate.update(timestamp=time).execute()
+
+    @staticmethod
+    def set_caught_up():
+        JobIndexUpdate.update(caught_up=True).execute()
+
+    @staticmethod
+    def current() -> 'JobIndexUpdate':
+        return JobIndexUpdate.get_by_id(1)
+
+    @staticmethod
+    def complete() -> bool:
+        '''Whether every job in SMRT Link, as of the last sync, has been indexed.'''
+        row = JobIndexUpdate.current()
+        return row.caught_up and row.timestamp >= row.until
+
+class PendingJob(peewee.Model):
+    '''
+    An analysis job which has not finished yet, whose files are to be staged
+    in `dir_path` (the directory of one of the job's datasets) once it has
+    completed successfully. A job of several datasets has a row for each.
+
+    `state`: the job's state when it was last checked.
+    `interval`: seconds between checks, which grows while the state does
+    not change (see `app.job.poll`).
+    '''
+    job_id = peewee.IntegerField()
+    job_name = peewee.CharField()
+    dir_path = peewee.CharField()
+    state = peewee.CharField()
+    added = peewee.DateTimeField(default=datetime.datetime.now)
+    interval = peewee.FloatField()
+    next_check = peewee.DateTimeField(index=True)
+
+    class Meta:
+        indexes = ((('job_id', 'dir_path'), True),)
+
+    @staticmethod
+    def add_many(rows: list[dict]):
+        '''Add a row for each dict of `job_id`, `job_name`, `dir_path`, `state`,
+        `interval` and `next_check`, unless the job is already pending for
+        the directory.'''
+        for chunk in peewee.chunked(rows, MAX_VARIABLES // 7):
+            PendingJob.insert_many(chunk).on_conflict_ignore().execute()
+
+    @staticmethod
+    def get_due() -> list['PendingJob']:
+        now = datetime.datetime.now()
+        return list(PendingJob.select().where(PendingJob.next_check <= now))
+
+    @staticmethod
+    def next_check_time() -> typing.Union[datetime.datetime, None]:
+        '''Get the time at which the next job is to be checked.'''
+        return PendingJob.select(peewee.fn.MIN(PendingJob.next_check)).scalar()
+
+    @staticmethod
+    def remove(pending_jobs: list['PendingJob']):
+        '''Remove the given rows only, not any added for the same jobs since
+        they were read.'''
+        ids = [pending_job.id for pending_job in pending_jobs]
+        for chunk in peewee.chunked(ids, MAX_VARIABLES):
+            PendingJob.delete().where(PendingJob.id.in_(chunk)).execute()
+
+class Event(peewee.Model):
+    '''
+    A notification from SMRT Link which has been accepted by the server but
+    not yet handled. Events are kept in the database so that notifications
+    accepted before a restart are still handled after it.
+
+    `kind`: one of the event kinds defined in `app.worker`.
+    `due`: the time before which the event should not be handled.
+    `claimed`: whether a worker is currently handling the event.
+    '''
+    kind = peewee.CharField()
+    project_id = peewee.IntegerField(null=True)
+    due = peewee.DateTimeField()
+    claimed = peewee.BooleanField(default=False)
+
+    class Meta:
+        indexes = ((('claimed', 'due'), False),)
+
+    @staticmethod
+    def add(kind: str, project_id: int = None, delay: float = 0, coalesce=False) -> 'Event':
+        '''Add an event which becomes due after `delay` seconds.
+
+        If `coalesce` is true and an unclaimed event of the same kind already
+        exists for the project, no event is added and the existing one is
+        returned, so that any number of notifications received before it
+        becomes due are handled once. An event which has been claimed is
+        not coalesced with, so a notification received while a project is
+        being handled results in exactly one follow-up event.'''
+        due = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+        with transaction():
+            if coalesce:
+                event = (Event.select()
+                              .where(Event.kind == kind,
+                                     Event.project_id == project_id,
+                                     Event.claimed == False)
+                              .first())
+                if event is not None:
+                    return event
+            return Event.create(kind=kind, project_id=project_id, due=due)
+
+    @staticmethod
+    def claim() -> typing.Union['Event', None]:
+        '''Claim the oldest unclaimed event which is due, if any. An event
+        can only be claimed by one worker, and events concerning a project
+        are not claimed while another event for the same project is.'''
+        now = datetime.datetime.now()
+        busy_projects = (Event.select(Event.project_id)
+                              .where(Event.claimed == True,
+                                     Event.project_id.is_null(False)))
+        with transaction():
+            event = (Event.select()
+                          .where(Event.claimed == False,
+                                 Event.due <= now,
+                                 Event.project_id.is_null() |
+                                 Event.project_id.not_in(busy_projects))
+                          .order_by(Event.due, Event.id)
+                          .first())
+            if event is None:
+                return None
+            claimed = (Event.update(claimed=True)
+                            .where(Event.id == event.id,
+                                   Event.claimed == False)
+                            .execute())
+            if not claimed:
+                return None
+        event.claimed = True
+        return event
+
+    @staticmethod
+    def next_due() -> typing.Union[datetime.datetime, None]:
+        '''Get the time at which the next unclaimed event becomes due.'''
+        return (Event.select(peewee.fn.MIN(Event.due))
+                     .where(Event.claimed == False)
+                     .scalar())
+
+    @staticmethod
+    def release_claimed():
+        '''Make claimed events available again. Events can only be claimed
+        when the app stops while handling them, so this is done at startup.'''
+        Event.update(claimed=False).where(Event.claimed == True).execute()
+
+    def done(self):
+        self.delete_instance()
+
+
+def _remove_duplicate_members():
+    '''Remove duplicate project members, which are now prevented by a
+    unique index.'''
+    first_ids = (ProjectMember.select(peewee.fn.MIN(ProjectMember.id))
+                              .group_by(ProjectMember.project_id, ProjectMember.member_id))
+    ProjectMember.delete().where(ProjectMember.id.not_in(first_ids)).execute()
+
+def _remove_extra_job_updates():
+    '''Remove the rows added to LastJobUpdate at each startup; only the first is used.'''
+    LastJobUpdate.delete().where(LastJobUpdate.id != 1).execute()
+
+# MIGRATIONS[i] upgrades a database from schema version i to version i + 1.
+# Indexes and tables are not created here; `migrate` creates any which are
+# missing once the migrations have run.
+MIGRATIONS = [
+    _remove_duplicate_members,
+    _remove_extra_job_updates,
+]
+
+FIRST_JOB_UPDATE = '2000-01-01T00:00:00.000Z' # jobs created since are synced by a new database
+
+def migrate():
+    '''Create the database's tables and indexes, first upgrading a database
+    created by an earlier version of the app. The schema version is kept in
+    SQLite's `user_version`.'''
+    with transaction():
+        version = db.pragma('user_version')
+        if version < len(MIGRATIONS) and db.table_exists(ProjectMember._meta.table_name):
+            for migration in MIGRATIONS[version:]:
+                app.logger.info(f'Migrating database: {migration.__name__}')
+                migration()
+        db.create_tables(models, safe=True)
+        db.pragma('user_version', len(MIGRATIONS))
+        if not LastJobUpdate.select().exists():
+            LastJobUpdate.create(timestamp=FIRST_JOB_UPDATE)
+        if not LastProject.select().exists():
+            LastProject.create(project_id=None)
+        if not JobIndexUpdate.select().exists(): # index jobs synced before the index existed
+            JobIndexUpdate.create(timestamp=FIRST_JOB_UPDATE, until=LastJobUpdate.time())
 
-models = [Dataset, ProjectMember, Permission, LastJobUpdate]
+models = [Dataset, ProjectMember, ProjectDatasets, Permission, ProjectPermission, LastProject, ProjectRetry, LastJobUpdate, JobRetry,
+          DatasetJob, JobIndexUpdate, PendingJob, Event]
 db.bind(models)
-db.create_tables(models, safe=True)
-LastJobUpdate.create(timestamp='2000-01-01T00:00:00.000Z')
\ No newline at end of file
+migrate()
\ No newline at end of file
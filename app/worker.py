@@ -0,0 +1,139 @@
+'''
+Notifications from SMRT Link are handled here, outside of the threads
+which serve HTTP requests. The server records each notification as an
+`app.state.Event` and responds right away. A fixed number of worker
+threads then take events from the database and pass them to `app.handle`.
+'''
+import datetime
+import threading
+
+import app.handle
+import app.state
+import app
+
+NEW_PROJECT = 'new_project'
+UPDATED_PROJECT = 'updated_project'
+DELETED_PROJECT = 'deleted_project'
+NEW_ANALYSES = 'new_analyses'
+RECONCILE_PERMISSIONS = 'reconcile_permissions'
+SWEEP_PERMISSIONS = 'sweep_permissions'
+
+IDLE_WAIT = 60 # max. seconds a worker waits before checking for events again
+
+def _handle(event: app.state.Event):
+    if event.kind == NEW_PROJECT:
+        app.handle.new_project()
+    elif event.kind == UPDATED_PROJECT:
+        app.handle.updated_project(event.project_id)
+    elif event.kind == DELETED_PROJECT:
+        app.handle.deleted_project(event.project_id)
+    elif event.kind == NEW_ANALYSES:
+        if app.handle.new_analyses(): # more jobs remain; handle them after any waiting events
+            app.state.Event.add(NEW_ANALYSES, coalesce=True)
+    elif event.kind == RECONCILE_PERMISSIONS:
+        app.handle.reconcile_permissions()
+    elif event.kind == SWEEP_PERMISSIONS:
+        app.handle.sweep_permissions()
+    else:
+        app.logger.error(f'Cannot handle event of unknown kind: {event.kind}')
+
+def _seconds_until(time: datetime.datetime) -> float:
+    return (time - datetime.datetime.now()).total_seconds()
+
+class Workers:
+    '''
+    A pool of threads which handle events from the database, in the order
+    they become due.
+    '''
+    def __init__(self, count: int):
+        self._count = count
+        self._threads = []
+        self._stopping = False
+        self._wakeup = threading.Condition()
+        self._stopped = threading.Event() # stops scheduled events
+
+    def enqueue(self, kind: str, project_id: int = None, delay: float = 0, coalesce=False):
+        '''Record an event in the database and wake a worker to handle it.
+        See `app.state.Event.add` regarding `coalesce`. Raises an exception
+        if the event cannot be recorded.'''
+        with app.state.connection():
+            app.state.Event.add(kind, project_id, delay, coalesce)
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def schedule(self, kind: str, interval: float):
+        '''Enqueue an event of the given kind every `interval` seconds,
+        starting now. A scheduled event is not enqueued again while the
+        previous one is still waiting to be handled.'''
+        def repeat():
+            while True:
+                try:
+                    self.enqueue(kind, coalesce=True)
+                except Exception as e:
+                    app.logger.error(f'Failed to queue scheduled {kind} event: {e}')
+                if self._stopped.wait(interval):
+                    return
+        thread = threading.Thread(target=repeat, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def start(self):
+        with app.state.connection():
+            app.state.Event.release_claimed()
+        for _ in range(self._count):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _wait(self):
+        '''Wait until the next event is due, or until woken by `enqueue`.'''
+        timeout = IDLE_WAIT
+        try:
+            with app.state.connection():
+                next_due = app.state.Event.next_due()
+        except Exception as e:
+            app.logger.error(f'Failed to get next event: {e}')
+            next_due = None
+        if next_due is not None:
+            timeout = min(max(_seconds_until(next_due), 0), IDLE_WAIT)
+        with self._wakeup:
+            if not self._stopping:
+                self._wakeup.wait(timeout)
+
+    def _handle_next(self) -> bool:
+        '''Claim and handle the next due event, if any. Return whether
+        there was one.'''
+        try:
+            event = app.state.Event.claim()
+        except Exception as e:
+            app.logger.error(f'Failed to claim next event: {e}')
+            return False
+        if event is None:
+            return False
+        try:
+            _handle(event)
+        except Exception as e:
+            app.logger.error(f'Failed to handle {event.kind} event: {e}')
+        finally:
+            event.done()
+        return True
+
+    def _run(self):
+        while not self._stopping:
+            try:
+                with app.state.connection(): # open only while handling an event
+                    handled = self._handle_next()
+            except Exception as e:
+                app.logger.error(f'Database error while handling events: {e}')
+                handled = False
+            if not handled:
+                self._wait()
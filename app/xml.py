@@ -1,13 +1,28 @@
+from __future__ import annotations
+import xml.etree.ElementTree as ET
+import concurrent.futures
+import multiprocessing
+import collections
+import threading
 import typing
+import os
 
-from pbcore.io.dataset.DataSetIO import DataSet as DatasetXml
-from pbcore.io.dataset.DataSetMembers import ExternalResource, ExternalResources
+import app
+
+if typing.TYPE_CHECKING: # pbcore is slow to import, so it is imported only where it is used
+    from pbcore.io.dataset.DataSetIO import DataSet as DatasetXml
+    from pbcore.io.dataset.DataSetMembers import ExternalResource, ExternalResources
+
+def _read_pbcore(xml_file) -> DatasetXml:
+    from pbcore.io.dataset.DataSetIO import DataSet as DatasetXml
+    return DatasetXml(xml_file)
 
 def _get_file_path(res, file_paths):
     '''
     Get the file path of a resource and recurse if it has 
     ExternalResources
     '''
+    from pbcore.io.dataset.DataSetMembers import ExternalResource
     if hasattr(res, 'resourceId'):
         file_paths.append(res.resourceId)
     if type(res) is ExternalResource: # else is FileIndex
@@ -35,7 +50,7 @@ def resources_to_file_paths(resources: ExternalResources):
 
 def _get_dataset_files(xml_file) -> list[str]:
     '''Returns all files associated with a dataset XML file.'''
-    ds = DatasetXml(xml_file)
+    ds = _read_pbcore(xml_file)
     primary_files = resources_to_file_paths(ds.externalResources)
     try: # TODO: how to handle split datasets?
         assert len(primary_files) == 1, f'Expected one resource file for dataset, found {len(primary_files)}'
@@ -44,23 +59,6 @@ def _get_dataset_files(xml_file) -> list[str]:
     supplemental_files = resources_to_file_paths(ds.supplementalResources)
     return primary_files + supplemental_files
 
-def _get_xml(xml_res: ExternalResource):
-    # one of the resource's externalResources is the sample XML
-    xml_files = [res.resourceId for res in xml_res.externalResources if res.resourceId.endswith('.xml')]
-    assert xml_files, 'No XML file found in externalResource'
-    return xml_files[0]
-
-def get_child_dataset_dicts(parent_xml):
-    '''Return a list (generator) of dictionaries of dataset data'''
-    for res in parent_xml.externalResources:
-        subdataset_xml_file = _get_xml(res)
-        child_xml = DatasetXml(subdataset_xml_file)
-        yield {
-            'name': child_xml.name,
-            'uuid': child_xml.uuid,
-            'path': subdataset_xml_file,
-        }
-
 def get_movie_id(xml: DatasetXml) -> typing.Union[str, None]:
     return (xml.metadata['Collections']
                         ['CollectionMetadata']
@@ -98,4 +96,258 @@ def get_barcode(xml: DatasetXml) -> typing.Union[str, None]:
                             .record['attrib']
                             ['Name'])
     except Exception as e:
-        return None
\ No newline at end of file
+        return None
+
+class DatasetInfo(typing.NamedTuple):
+    '''The fields of a dataset XML file which are used by the app.'''
+    uuid: str
+    name: str
+    movie_id: typing.Union[str, None]
+    sample_name: typing.Union[str, None]
+    well_sample_name: typing.Union[str, None]
+    barcode: typing.Union[str, None]
+    files: tuple[str, ...] # from externalResources
+    supplemental_files: tuple[str, ...] # from supplementalResources
+    child_paths: tuple[str, ...] # XML files of child datasets, if any
+
+def _get_or_none(getter, xml: DatasetXml):
+    try:
+        return getter(xml)
+    except Exception:
+        return None
+
+def _get_child_paths(xml: DatasetXml) -> tuple[str, ...]:
+    paths = []
+    for res in xml.externalResources:
+        xml_files = [r.resourceId for r in res.externalResources if r.resourceId.endswith('.xml')]
+        if xml_files:
+            paths.append(xml_files[0])
+    return tuple(paths)
+
+def _parse_pbcore(path: str) -> DatasetInfo:
+    xml = _read_pbcore(path)
+    return DatasetInfo(
+        uuid=xml.uuid,
+        name=xml.name,
+        movie_id=_get_or_none(get_movie_id, xml),
+        sample_name=_get_or_none(get_sample_name, xml),
+        well_sample_name=_get_or_none(get_well_sample_name, xml),
+        barcode=get_barcode(xml),
+        files=tuple(resources_to_file_paths(xml.externalResources)),
+        supplemental_files=tuple(resources_to_file_paths(xml.supplementalResources)),
+        child_paths=_get_child_paths(xml),
+    )
+
+def _local_name(tag: str) -> str:
+    return tag.rpartition('}')[2] # drop the namespace
+
+def _resolve(xml_dir: str, resource_id: str) -> str:
+    '''Return the absolute path of a resource, as pbcore does.'''
+    if resource_id.startswith('file://'):
+        resource_id = resource_id[len('file://'):]
+    return os.path.normpath(os.path.join(xml_dir, resource_id))
+
+def _parse_stream(path: str) -> DatasetInfo:
+    '''
+    Extract the fields of a DatasetInfo in a single pass over a dataset
+    XML file. Elements are discarded as soon as they have been read, so
+    the document is never held in memory as a whole. Of the metadata, only
+    the first CollectionMetadata, its WellSample and the WellSample's first
+    BioSample are read, matching the functions above which use pbcore.
+    '''
+    xml_dir = os.path.dirname(os.path.abspath(path))
+    fields = dict.fromkeys(['uuid', 'name', 'movie_id', 'sample_name',
+                            'well_sample_name', 'barcode'])
+    found = set()
+    resources = {'ExternalResources': [], 'SupplementalResources': []}
+    child_paths = []
+    num_resources = 0 # top-level ExternalResource elements seen so far
+    num_collections = 0
+    num_bio_samples = 0
+    stack = [] # local names of the open elements
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'end':
+            stack.pop()
+            elem.clear()
+            continue
+        tag = _local_name(elem.tag)
+        stack.append(tag)
+        depth = len(stack)
+        parent = stack[-2] if depth > 1 else None
+        if depth == 1:
+            fields['uuid'] = elem.get('UniqueId')
+            fields['name'] = elem.get('Name')
+        elif tag in ('ExternalResource', 'FileIndex') and stack[1] in resources:
+            if tag == 'ExternalResource' and depth == 3 and stack[1] == 'ExternalResources':
+                num_resources += 1
+            if elem.get('ResourceId') is None:
+                continue
+            file_path = _resolve(xml_dir, elem.get('ResourceId'))
+            resources[stack[1]].append(file_path)
+            if (tag == 'ExternalResource' and depth == 5 and stack[1] == 'ExternalResources'
+                    and file_path.endswith('.xml') and len(child_paths) < num_resources):
+                child_paths.append(file_path) # first XML file of each top-level resource
+        elif tag == 'CollectionMetadata':
+            num_collections += 1
+            if num_collections == 1:
+                fields['movie_id'] = elem.get('Context')
+        elif num_collections != 1 or 'CollectionMetadata' not in stack:
+            continue
+        elif tag == 'WellSample' and parent == 'CollectionMetadata' and tag not in found:
+            found.add(tag)
+            fields['well_sample_name'] = elem.get('Name')
+        elif tag == 'BioSample' and parent == 'BioSamples' and stack[-3] == 'WellSample':
+            num_bio_samples += 1
+            if num_bio_samples == 1:
+                fields['sample_name'] = elem.get('Name')
+        elif (tag == 'DNABarcode' and parent == 'DNABarcodes' and stack[-3] == 'BioSample'
+                and num_bio_samples == 1 and tag not in found):
+            found.add(tag)
+            fields['barcode'] = elem.get('Name')
+    if fields['uuid'] is None:
+        raise ValueError(f'{path} is not a dataset XML file')
+    return DatasetInfo(
+        files=tuple(resources['ExternalResources']),
+        supplemental_files=tuple(resources['SupplementalResources']),
+        child_paths=tuple(child_paths),
+        **fields,
+    )
+
+def _parse(path: str, parser: str = None) -> DatasetInfo:
+    '''Parse a dataset XML file with `parser`, by default the one selected
+    by `app.XML_PARSER`. If the streaming parser fails, pbcore is tried
+    before giving up.'''
+    if (parser or app.XML_PARSER) == 'pbcore':
+        return _parse_pbcore(path)
+    try:
+        return _parse_stream(path)
+    except Exception as e:
+        try:
+            info = _parse_pbcore(path)
+        except ImportError:
+            raise e
+        app.logger.warning(f'Parsed {path} with pbcore because streaming parser failed: {e}')
+        return info
+
+_cache = collections.OrderedDict() # (path, mtime, size) -> DatasetInfo, least recently used first
+_cache_lock = threading.Lock()
+_hits = 0
+_misses = 0
+
+PARALLEL_PARSE_THRESHOLD = 8 # min. uncached files for which parsing is spread across processes
+
+def _cache_key(path: str) -> tuple:
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+def _cache_get(key) -> typing.Union[DatasetInfo, None]:
+    global _hits, _misses
+    with _cache_lock:
+        info = _cache.get(key)
+        if info is None:
+            _misses += 1
+            return None
+        _cache.move_to_end(key)
+        _hits += 1
+        return info
+
+def _cache_put(key, info: DatasetInfo):
+    with _cache_lock:
+        _cache[key] = info
+        _cache.move_to_end(key)
+        while len(_cache) > max(app.XML_CACHE_SIZE, 0):
+            _cache.popitem(last=False)
+
+def load(path: str) -> DatasetInfo:
+    '''Return the fields of a dataset XML file, parsing the file only if it
+    has not been parsed since it was last modified. Raises an exception if
+    the file cannot be read or parsed.'''
+    key = _cache_key(path)
+    info = _cache_get(key)
+    if info is None:
+        info = _parse(path) # parse outside of the lock so other files can be loaded meanwhile
+        _cache_put(key, info)
+    return info
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    '''Get the pool of processes which parse XML, shared by all threads and
+    started when first needed. Its processes are started by a fork server
+    rather than forked from the app, whose other threads could be holding
+    locks which a forked process would inherit.'''
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            context = multiprocessing.get_context('forkserver')
+            _pool = concurrent.futures.ProcessPoolExecutor(app.CHILD_PARSE_WORKERS, mp_context=context)
+        return _pool
+
+def _discard_pool(pool: concurrent.futures.ProcessPoolExecutor):
+    '''Shut down a broken pool, so that the next one needed is started anew.'''
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+def _parse_all(paths: list[str]) -> list:
+    '''Parse each file, returning its DatasetInfo or the exception raised.
+    XML parsing is CPU-bound, so many files are parsed in separate processes.'''
+    if app.CHILD_PARSE_WORKERS > 1 and len(paths) >= PARALLEL_PARSE_THRESHOLD:
+        pool = None
+        try:
+            pool = _get_pool()
+            futures = [pool.submit(_parse, path, app.XML_PARSER) for path in paths]
+            results = [future.exception() or future.result() for future in futures]
+            broken = [r for r in results if isinstance(r, concurrent.futures.process.BrokenProcessPool)]
+            if not broken:
+                return results
+            raise broken[0]
+        except (OSError, ValueError, RuntimeError) as e: # BrokenProcessPool is a RuntimeError
+            app.logger.warning(f'Failed to parse dataset XML files in parallel, parsing one at a time: {e}')
+            if pool is not None:
+                _discard_pool(pool)
+    results = []
+    for path in paths:
+        try:
+            results.append(_parse(path))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def load_many(paths: list[str]) -> list:
+    '''Like `load`, but for many files at once. Returns a list in the same
+    order as `paths`, holding for each file either its DatasetInfo or the
+    exception which prevented it from being loaded.'''
+    results = [None] * len(paths)
+    keys = [None] * len(paths)
+    uncached = []
+    for i, path in enumerate(paths):
+        try:
+            keys[i] = _cache_key(path)
+        except OSError as e:
+            results[i] = e
+            continue
+        results[i] = _cache_get(keys[i])
+        if results[i] is None:
+            uncached.append(i)
+    for i, result in zip(uncached, _parse_all([paths[i] for i in uncached])):
+        results[i] = result
+        if not isinstance(result, Exception):
+            _cache_put(keys[i], result)
+    return results
+
+def cache_info() -> dict:
+    '''Return hit and miss counts and the current size of the XML cache.'''
+    with _cache_lock:
+        return {'hits': _hits, 'misses': _misses,
+                'size': len(_cache), 'max_size': app.XML_CACHE_SIZE}
+
+def cache_clear():
+    global _hits, _misses
+    with _cache_lock:
+        _cache.clear()
+        _hits = 0
+        _misses = 0
\ No newline at end of file
@@ -1,4 +1,8 @@
+import tracemalloc
 import os
+import gc
+from unittest.mock import patch
+import pytest
 
 import app.collection
 import test.data
@@ -65,4 +69,69 @@ def test_tomato_20():
 def test_supplemental_resources():
     ds = app.collection.SupplementalResources('parent', ['file1', 'file2'])
     assert ds.dir_path == 'parent/Supplemental Run Data'
-    assert ds.files == ['file1', 'file2']
+    assert ds.files == ('file1', 'file2')
+
+def test_parent_supplemental_resources():
+    ds = app.collection.Dataset(**test.data.DATASET_1)
+    supplemental = ds.child_datasets[-1]
+    assert type(supplemental) is app.collection.SupplementalResources
+    assert ds.files == ()
+    assert len(supplemental.files) == 19
+    assert supplemental.files is supplemental.files # computed once
+    assert all(os.path.isabs(f) for f in supplemental.files)
+
+
+def test_dataset_record():
+    record = app.collection.DatasetRecord('1', 'Tomato 20', 'm1', 'bc1047--bc1047', 'dir', ['a', 'b'])
+    assert record.files == ('a', 'b')
+    assert isinstance(record, app.BaseDataset)
+    assert not hasattr(record, '__dict__')
+    with pytest.raises(AttributeError):
+        record.dir_path = 'other'
+
+def synthetic_info(path):
+    '''Return the DatasetInfo of a synthetic dataset: path "parent/<i>" is
+    a parent with 8 children, and "<i>/<j>" is one of its children.'''
+    i = path.rpartition('/')[2]
+    return app.xml.DatasetInfo(
+        uuid=f'{path}-uuid', name=f'dataset {path}', movie_id='m84100_240301_194028_s1',
+        sample_name=f'Sample {path}', well_sample_name=f'Well sample {path}',
+        barcode=f'bc10{i}--bc10{i}',
+        files=(f'/data/{path}.hifi_reads.bam', f'/data/{path}.hifi_reads.bam.pbi'),
+        supplemental_files=tuple(f'/data/{path}.supplemental.{j}.txt' for j in range(19)),
+        child_paths=tuple(f'{path}/{j}' for j in range(8)) if path.startswith('parent') else ())
+
+def test_children_not_loaded_again():
+    loaded = []
+    def load(path):
+        loaded.append(path)
+        return synthetic_info(path)
+    with patch('app.xml.load', load), \
+         patch('app.xml.load_many', lambda ps: [synthetic_info(p) for p in ps]):
+        parent = app.collection.Dataset(uuid='parent', name='parent', path='parent/1', numChildren=8)
+    assert len(parent.child_datasets) == 9 # with the supplemental resources
+    assert loaded == ['parent/1'] # each child's XML is used as load_many parsed it
+
+def retained_memory(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        kept = build()
+        gc.collect()
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        del kept
+        tracemalloc.stop()
+
+def test_records_use_less_memory():
+    '''Compare the memory retained by the datasets of a synthetic project of
+    250 parents, 8 children each, with that retained by their records.'''
+    paths = [f'parent/{i}' for i in range(250)]
+    def datasets():
+        return [app.collection.Dataset(uuid=path, name=path, path=path, numChildren=8)
+                for path in paths]
+    with patch('app.xml.load', synthetic_info), \
+         patch('app.xml.load_many', lambda ps: [synthetic_info(p) for p in ps]):
+        dataset_memory = retained_memory(datasets)
+        record_memory = retained_memory(lambda: [ds.record() for ds in datasets()])
+    assert record_memory * 20 < dataset_memory
@@ -0,0 +1,73 @@
+import os
+import pytest
+from unittest.mock import patch
+
+import app.collection
+import app.filesystem
+
+@pytest.fixture
+def staging_root(tmp_path):
+    root = tmp_path / 'staging'
+    root.mkdir()
+    with patch('app.STAGING_ROOT', str(root)):
+        yield root
+
+@pytest.fixture
+def source_files(tmp_path):
+    files = []
+    for name in ('a.bam', 'a.bam.pbi', 'b.bam'):
+        path = tmp_path / name
+        path.write_text(name)
+        files.append(str(path))
+    return files
+
+def test_stage_many(staging_root, source_files):
+    collections = [app.collection.SupplementalResources('one', source_files[:2]),
+                   app.collection.SupplementalResources('two', source_files[2:])]
+    assert app.filesystem.stage_many(collections) == [True, True]
+    staged = staging_root / 'one' / 'Supplemental Run Data' / 'a.bam'
+    assert os.path.samefile(staged, source_files[0])
+    # staging again is a no-op
+    assert app.filesystem.stage_many(collections) == [True, True]
+
+def test_stage_many_reports_each_collection(staging_root, source_files):
+    missing = app.collection.SupplementalResources('missing', ['/no/such/file'])
+    present = app.collection.SupplementalResources('present', source_files)
+    assert app.filesystem.stage_many([missing, present]) == [False, True]
+
+def test_stage_conflicting_file(staging_root, source_files):
+    collection = app.collection.SupplementalResources('dir', source_files[:1])
+    conflict = staging_root / 'dir' / 'Supplemental Run Data' / 'a.bam'
+    conflict.parent.mkdir(parents=True)
+    conflict.write_text('another file')
+    assert not app.filesystem.stage(collection)
+
+class StagedDataset(app.BaseDataset):
+    def __init__(self, dir_path):
+        self._dir_path = dir_path
+    @property
+    def uuid(self):
+        return 'uuid'
+    @property
+    def dir_path(self):
+        return self._dir_path
+
+def test_remove_nested_dirs(staging_root, source_files):
+    parent = staging_root / 'parent'
+    for dir in ('child 1', 'child 2/Analysis 1'):
+        (parent / dir).mkdir(parents=True)
+        for filepath in source_files:
+            os.link(filepath, parent / dir / os.path.basename(filepath))
+    with patch('app.filesystem.APP_UID', os.getuid()), \
+         patch('app.filesystem.PARALLEL_UNLINK_THRESHOLD', 4):
+        assert app.filesystem.remove(StagedDataset('parent'))
+    assert not parent.exists()
+    assert all(os.path.exists(filepath) for filepath in source_files)
+
+def test_remove_keeps_files_of_others(staging_root, source_files):
+    dir = staging_root / 'dataset'
+    dir.mkdir()
+    os.link(source_files[0], dir / 'a.bam')
+    with patch('app.filesystem.APP_UID', os.getuid() + 1):
+        assert not app.filesystem.remove(StagedDataset('dataset'))
+    assert (dir / 'a.bam').exists()
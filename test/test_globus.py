@@ -1,3 +1,4 @@
+import globus_sdk
 import pytest
 import unittest.mock
 
@@ -18,10 +19,12 @@ class Dataset(app.BaseDataset):
     def dir_path(self):
         return self._dir_path
 
-@pytest.fixture(autouse=True)
+@pytest.fixture
 def validate_transfer_client():
+    '''Needed by the tests which use the real Globus API.'''
     assert app.globus.TRANSFER_CLIENT is not None
 
+@pytest.mark.usefixtures('validate_transfer_client')
 def test_invalid_path():
     with unittest.mock.patch('app.logger.error') as log_error:
         dataset = Dataset('uuid', 'invalid')
@@ -29,6 +32,7 @@ def test_invalid_path():
         app.globus.create_permission(dataset, member_id)
         assert log_error.called
 
+@pytest.mark.usefixtures('validate_transfer_client')
 def test_permission_exists():
     with unittest.mock.patch('app.logger.error') as log_error:
         dataset = Dataset('uuid', '/test')
@@ -36,9 +40,59 @@ def test_permission_exists():
         app.globus.create_permission(dataset, member_id)
         assert log_error.called
 
+@pytest.mark.usefixtures('validate_transfer_client')
 def test_success():
     with unittest.mock.patch('app.logger.error') as log_error:
         dataset = Dataset('uuid', '/test')
         member_id = '65af3497-1ad5-4a79-8c5b-cec928605c1c' # adkna@globusid.org
         app.globus.create_permission(dataset, member_id)
-        assert not log_error.called
\ No newline at end of file
+        assert not log_error.called
+
+def test_create_permissions_reports_each_request():
+    def add_rule(collection_id, rule_data):
+        if rule_data['principal'] == 'bad':
+            raise globus_sdk.GlobusError('invalid principal')
+        return {'access_id': f"{rule_data['principal']}:{rule_data['path']}"}
+    requests = [('uuid1', '/dir1', 'member1'),
+                ('uuid2', '/dir2', 'bad'),
+                ('uuid2', '/dir2', 'member1')]
+    with unittest.mock.patch('app.globus.TRANSFER_CLIENT') as client:
+        client.add_endpoint_acl_rule.side_effect = add_rule
+        results = app.globus.create_permissions(requests)
+    assert [result.member_id for result in results] == ['member1', 'bad', 'member1']
+    assert results[1].error is not None and results[1].permission_id is None
+    assert app.state.Permission.get_by('member1', 'uuid2').id == 'member1:/dir2/'
+    assert app.state.Permission.get_by('bad', 'uuid2') is None
+    with unittest.mock.patch('app.globus.TRANSFER_CLIENT') as client:
+        results = app.globus.delete_permissions(list(app.state.Permission.get_by_dataset_id('uuid2')))
+    assert len(results) == 1 and results[0].error is None
+    assert app.state.Permission.get_by('member1', 'uuid2') is None
+
+def test_reconcile():
+    app.state.Permission.insert(id='rule1', member_id='member1', dataset_uuid='uuid1',
+                                expiry='2100-01-01T00:00:00').execute()
+    app.state.Permission.insert(id='lost', member_id='member1', dataset_uuid='uuid2',
+                                expiry='2100-01-01T00:00:00').execute()
+    rules = [
+        {'id': 'duplicate', 'principal_type': 'identity', 'principal': 'member1', 'path': '/dir1/'},
+        {'id': 'rule1', 'principal_type': 'identity', 'principal': 'member1', 'path': '/dir1/'},
+        {'id': 'rule2', 'principal_type': 'identity', 'principal': 'member2', 'path': '/dir1/'},
+        {'id': 'rule3', 'principal_type': 'identity', 'principal': 'former', 'path': '/dir1/'},
+        {'id': 'admin2', 'principal_type': 'identity', 'principal': 'admin', 'path': '/'}, # not managed, so left alone
+        {'id': 'admin', 'principal_type': 'identity', 'principal': 'admin', 'path': '/'},
+    ]
+    desired = {
+        ('member1', 'dir1'): ('uuid1', None),
+        ('member2', 'dir1'): ('uuid1', None),
+        ('member1', 'dir2'): ('uuid2', None),
+    }
+    with unittest.mock.patch('app.globus.TRANSFER_CLIENT') as client:
+        client.endpoint_acl_list.return_value = rules
+        client.add_endpoint_acl_rule.return_value = {'access_id': 'rule4'}
+        report = app.globus.reconcile(desired, {'dir1', 'dir2'})
+    client.add_endpoint_acl_rule.assert_called_once()
+    assert client.add_endpoint_acl_rule.call_args.args[1]['path'] == '/dir2/'
+    assert [call.args[1] for call in client.delete_endpoint_acl_rule.call_args_list] == ['rule3', 'duplicate']
+    assert report['added'] == 1 and report['removed'] == 2 and report['failed'] == 0
+    assert {p.id for p in app.state.Permission.select()} == {'rule1', 'rule2', 'rule4'}
+    app.state.Permission.delete().execute()
@@ -1,15 +1,17 @@
+import datetime
 import unittest.mock
 import pytest
 
 import test.data
 import app.handle
+import app.smrtlink
 import app.state
 
 STAGE = 1
 UNSTAGE = 2
 TRACK_JOB = 3
 INSERT_MEMBER = 4
-MEMBER_EXISTS = 5
+MEMBER_IDS = 5
 GET_REMOVED_MEMBERS = 6
 GET_DATASET = 7
 INSERT_DATASET = 8
@@ -21,27 +23,35 @@ GET_ANALYSES = 13
 REMOVE_MEMBER = 14
 REMOVE_DATASET = 15
 UPDATE_DATASET_PROJECT = 16
+DELETE_PERMISSIONS = 17
+GET_FINGERPRINT = 18
+SET_FINGERPRINT = 19
+GET_PROJECT_DATASETS = 20
 
 from unittest.mock import patch
 patchers = {
     # functions which modify the state of the app, or interact with external services
-    STAGE: patch('app.filesystem.stage', return_value=True),
+    STAGE: patch('app.filesystem.stage_many', side_effect=lambda collections: [True] * len(collections)),
     UNSTAGE: patch('app.filesystem.remove', return_value=True),
-    INSERT_MEMBER: patch('app.state.ProjectMember.insert'),
-    INSERT_DATASET: patch('app.state.Dataset.insert'),
-    CREATE_PERMISSION: patch('app.globus.create_permission'),
+    INSERT_MEMBER: patch('app.state.ProjectMember.add_many'),
+    INSERT_DATASET: patch('app.state.Dataset.add_many'),
+    CREATE_PERMISSION: patch('app.globus.create_permissions', return_value=[]),
+    DELETE_PERMISSIONS: patch('app.globus.delete_permissions', return_value=[]),
     REMOVE_PERMISSIONS: patch('app.globus.remove_permissions'),
     REMOVE_PERMISSION: patch('app.globus.remove_permission'),
     REMOVE_MEMBER: patch('app.state.ProjectMember.delete_instance'),
     REMOVE_DATASET: patch('app.state.Dataset.delete_instance'),
-    UPDATE_DATASET_PROJECT: patch('app.state.Dataset.update_project_id'),
+    UPDATE_DATASET_PROJECT: patch('app.state.Dataset.update_project_ids'),
+    SET_FINGERPRINT: patch('app.state.ProjectDatasets.set_fingerprint'),
     # functions which query the state of the app
     GET_REMOVED_DATASETS: patch('app.state.Dataset.get_removed_datasets', return_value=[]),
     GET_ANALYSES: patch('app.job.get_analyses', return_value=([], [])),
     TRACK_JOB: patch('app.job.track'),
-    MEMBER_EXISTS: patch('app.state.ProjectMember.exists', return_value=False),
+    MEMBER_IDS: patch('app.state.ProjectMember.get_member_ids', return_value=set()),
     GET_REMOVED_MEMBERS: patch('app.state.ProjectMember.get_removed_members', return_value=[]),
-    GET_DATASET: patch('app.state.Dataset.get_by_dataset_uuid', return_value=None),
+    GET_DATASET: patch('app.state.Dataset.get_by_uuids', return_value={}),
+    GET_FINGERPRINT: patch('app.state.ProjectDatasets.get_fingerprint', return_value=None),
+    GET_PROJECT_DATASETS: patch('app.state.Dataset.get_by_project_id', return_value=[]),
 }
 
 @pytest.fixture
@@ -73,6 +83,8 @@ def test_empty_project(mock: dict[int, unittest.mock.MagicMock]):
 def test_new_dataset(mock: dict[int, unittest.mock.MagicMock], dataset):
     call_handle_project(1, [dataset[1]], [])
     mock[INSERT_DATASET].assert_called_once()
+    [row] = mock[INSERT_DATASET].call_args.args[0]
+    assert row['uuid'] == dataset[1]['uuid'] and row['project_id'] == 1
     mock[STAGE].assert_called()
 
 def simulate_app_state(mock: dict[int, unittest.mock.MagicMock], state_project_id, dataset_dicts, member_ids):
@@ -83,24 +95,21 @@ def simulate_app_state(mock: dict[int, unittest.mock.MagicMock], state_project_i
     What this actually does is create some mock side effects for the functions
     which query the state of the app.
     '''
-    def get_dataset(uuid):
-        if uuid in [d['uuid'] for d in dataset_dicts]:
-            return app.state.Dataset(uuid=uuid, project_id=state_project_id, dir_path='whatever')        
-        else:
-            return None
-    def project_member_exists(project_id, member_id):
-        if member_id in member_ids and \
-            state_project_id == project_id:
-            return True
-        return False
-    mock[GET_DATASET].side_effect = get_dataset
-    mock[MEMBER_EXISTS].side_effect = project_member_exists
+    def get_datasets(uuids):
+        return {d['uuid']: app.state.Dataset(uuid=d['uuid'], project_id=state_project_id, dir_path='whatever')
+                for d in dataset_dicts if d['uuid'] in uuids}
+    def get_member_ids(project_id):
+        if state_project_id == project_id:
+            return set(member_ids)
+        return set()
+    mock[GET_DATASET].side_effect = get_datasets
+    mock[MEMBER_IDS].side_effect = get_member_ids
 
 def test_reassigned_dataset(mock: dict[int, unittest.mock.MagicMock], dataset):
     simulate_app_state(mock, 1, [dataset[1]], [])
     NEW_PROJECT_ID = 2
     call_handle_project(NEW_PROJECT_ID, [dataset[1]], [])
-    mock[UPDATE_DATASET_PROJECT].assert_called_once_with(NEW_PROJECT_ID)
+    mock[UPDATE_DATASET_PROJECT].assert_called_once_with({dataset[1]['uuid']: NEW_PROJECT_ID})
     mock[INSERT_DATASET].assert_not_called()
     mock[STAGE].assert_not_called()
 
@@ -126,4 +135,88 @@ def test_new_member(mock: dict[int, unittest.mock.MagicMock], member):
     simulate_app_state(mock, 1, [], [member[1]])
     call_handle_project(2, [], [member[1]])
     mock[INSERT_MEMBER].assert_called_once()
-    mock[INSERT_MEMBER].reset_mock()
\ No newline at end of file
+    mock[INSERT_MEMBER].reset_mock()
+
+def test_unchanged_datasets_skipped(mock: dict[int, unittest.mock.MagicMock], dataset, member):
+    call_handle_project(1, [dataset[1], dataset[2]], [])
+    fingerprint = app.smrtlink.datasets_fingerprint([dataset[2], dataset[1]])
+    mock[SET_FINGERPRINT].assert_called_once_with(1, fingerprint)
+    # only the members of the project have changed since
+    known = [app.state.Dataset(uuid=d['uuid'], project_id=1, dir_path='whatever') for d in (dataset[1], dataset[2])]
+    mock[GET_FINGERPRINT].return_value = fingerprint
+    mock[GET_PROJECT_DATASETS].return_value = known
+    mock[STAGE].reset_mock()
+    call_handle_project(1, [dataset[1], dataset[2]], [member[1]])
+    mock[STAGE].assert_not_called()
+    for i in (GET_DATASET, GET_REMOVED_DATASETS):
+        mock[i].assert_called_once() # by the first call only
+    mock[INSERT_MEMBER].assert_called_once_with(1, [member[1]])
+    [requests] = mock[CREATE_PERMISSION].call_args.args
+    assert {(uuid, member_id) for uuid, _, member_id in requests} == \
+           {(dataset[1]['uuid'], member[1]), (dataset[2]['uuid'], member[1])}
+
+def test_failed_dataset_not_fingerprinted(mock: dict[int, unittest.mock.MagicMock], dataset):
+    mock[STAGE].side_effect = lambda collections: [False] * len(collections)
+    call_handle_project(1, [dataset[1]], [])
+    mock[SET_FINGERPRINT].assert_not_called()
+
+def test_project_directory_permissions(mock: dict[int, unittest.mock.MagicMock], member):
+    with patch('app.PROJECT_DIRECTORIES', True), \
+         patch('app.filesystem.make_project_dir', return_value=True), \
+         patch('app.state.ProjectPermission.get_member_ids', return_value={member[2]}), \
+         patch('app.globus.delete_project_permissions', return_value=[]) as delete_project_permissions, \
+         patch('app.globus.create_project_permissions', return_value=[]) as create_project_permissions:
+        call_handle_project(1, [], [member[1]])
+    create_project_permissions.assert_called_once_with(1, 'Project 1', [member[1]])
+    delete_project_permissions.assert_called_once_with(1, 'Project 1', [member[2]])
+    mock[CREATE_PERMISSION].assert_not_called()
+
+def test_new_projects(member):
+    projects = [(5, [], [member[1]]), (6, [], [member[2]]), (8, [], [])]
+    def handle_project(project_id, dataset_dicts, member_ids):
+        if project_id == 6:
+            raise Exception('Globus unavailable')
+    with patch('app.smrtlink.get_new_projects', return_value=iter(projects)) as get_new_projects, \
+         patch('app.handle._handle_project', side_effect=handle_project) as handle:
+        app.handle.new_project()
+    get_new_projects.assert_called_once_with(None)
+    assert [call.args[0] for call in handle.call_args_list] == [5, 6, 8]
+    assert app.state.LastProject.latest() == 8
+    [retry] = app.state.ProjectRetry.select()
+    assert (retry.project_id, retry.error) == (6, 'Globus unavailable')
+    app.state.LastProject.set(None)
+    app.state.ProjectRetry.delete().execute()
+
+def test_failed_project_retried(member):
+    app.state.ProjectRetry.add(6, 'Globus unavailable')
+    app.state.ProjectRetry.update(due=datetime.datetime.now()).execute()
+    with patch('app.smrtlink.get_new_projects', return_value=iter([])), \
+         patch('app.smrtlink.get_project', return_value=([], [member[2]])) as get_project, \
+         patch('app.handle._handle_project', side_effect=[Exception('Globus unavailable'), None]) as handle:
+        app.handle.new_project()
+        [retry] = app.state.ProjectRetry.select()
+        assert retry.attempts == 2
+        app.handle.new_project() # not yet due
+        app.state.ProjectRetry.update(due=datetime.datetime.now()).execute()
+        app.handle.new_project()
+    assert get_project.call_count == handle.call_count == 2
+    handle.assert_called_with(6, [], [member[2]])
+    assert app.state.ProjectRetry.select().count() == 0
+    app.state.LastProject.set(None)
+
+def test_desired_permissions_follow_staged_location(member):
+    app.state.Dataset.delete().execute()
+    app.state.ProjectMember.delete().execute()
+    app.state.Dataset.create(uuid='flat', project_id=3, dir_path='flat dir')
+    app.state.Dataset.create(uuid='moved', project_id=3, dir_path='Project 3/moved dir')
+    app.state.ProjectMember.insert(project_id=3, member_id=member[1]).execute()
+    try:
+        for project_directories in (True, False):
+            with patch('app.PROJECT_DIRECTORIES', project_directories):
+                desired, managed_dir_paths = app.handle._desired_permissions()
+            assert desired == {(member[1], 'flat dir'): ('flat', None),
+                               (member[1], 'Project 3'): (None, 3)}
+            assert managed_dir_paths == {'flat dir', 'Project 3/moved dir', 'Project 3'}
+    finally:
+        app.state.Dataset.delete().execute()
+        app.state.ProjectMember.delete().execute()
@@ -1,110 +1,213 @@
+import datetime
 import pytest
 from unittest.mock import MagicMock, patch
-from app.job import _poll
 import app.job as job
-
-@patch('time.sleep')
-@patch('app.smrtlink.get_job')
-def test_poll_successful_analysis(mock_get_job, mock_sleep):
-    analysis = MagicMock()
-    analysis.id = "123"
-    mock_get_job.return_value = {"state": "SUCCESSFUL"}
-    staging_function = MagicMock()
-
-    _poll(analysis, staging_function)
-    staging_function.assert_called_once_with(analysis)
-    mock_sleep.assert_not_called()
-
-@patch('time.sleep')
-@patch('app.smrtlink.get_job')
-def test_poll_eventual_success(mock_get_job, mock_sleep):
-    analysis = MagicMock()
-    analysis.id = "123"
-    mock_get_job.side_effect = [{"state": "RUNNING"}, {"state": "SUCCESSFUL"}]
-    staging_function = MagicMock()
-
-    _poll(analysis, staging_function)
-    staging_function.assert_called_once_with(analysis)
-    mock_sleep.assert_called_once()
-
-@patch('app.smrtlink.get_job')
-def test_poll_failed_analysis(mock_get_job):
-    analysis = MagicMock()
-    analysis.id = "123"
-    mock_get_job.return_value = {"state": "FAILED"}
-    staging_function = MagicMock()
-
-    _poll(analysis, staging_function)
-    staging_function.assert_not_called()
-
-@patch('app.job.logger')
-@patch('app.smrtlink.get_job')
-def test_poll_timeout(mock_get_job, mock_logger):
-    analysis = MagicMock()
-    analysis.id = "123"
-    mock_get_job.return_value = {"state": "RUNNING"}
-    staging_function = MagicMock()
-
-    with patch('app.job.MAX_POLLING_TIME', 0):
-        _poll(analysis, staging_function)
-
-    staging_function.assert_not_called()
-    mock_logger.error.assert_called_once()
-
-@patch('time.sleep')
-@patch('app.smrtlink.get_job')
-def test_track_and_poll(mock_get_job, mock_sleep):
-    analysis = MagicMock()
-    analysis.id = "123"
-    mock_get_job.return_value = {"state": "SUCCESSFUL"}
-    staging_function = MagicMock()
-
-    job.track([analysis], staging_function)
-    staging_function.assert_called_once_with(analysis)
-    mock_sleep.assert_not_called()
-
-@patch('app.job.logger')
-@patch('app.job.smrtlink.get_jobs_created_after')
-def test_get_new_jobs_smrtlink_exception(get_jobs_created_after, logger):
-    get_jobs_created_after.side_effect = Exception()
-    assert job._get_new_jobs() == []
-    logger.error.assert_called_once()
-
-@patch('app.job.LastJobUpdate')
-@patch('app.job.smrtlink.get_jobs_created_after')
-def test_get_new_jobs_success(get_jobs_created_after, LastJobUpdate):
-    get_jobs_created_after.return_value = [{"createdAt": 'timestamp2'},{"createdAt": 'timestamp1'}]
-    job._get_new_jobs()
-    LastJobUpdate.set.assert_called_once_with('timestamp2')
-
-@patch('app.job._get_new_jobs')
-@patch('app.job._get_dataset_dirs')
-@patch('app.job.smrtlink.get_job_files')
-@patch('app.job.smrtlink.get_job_datasets')
-def test_get_new_analyses(get_job_datasets, get_job_files, get_dataset_dirs, get_new_jobs):
-    get_new_jobs.return_value = [{'name': 'analyze', "id": "123", "state": "FAILED"}]
-    get_job_datasets.return_value = [1]
-    get_dataset_dirs.return_value = ["dir1"]
-    get_job_files.return_value = ["file1"]
-    completed, pending = job.get_new_analyses()
-
-    assert len(completed) == 0
-    assert len(pending) == 0
-
-    get_new_jobs.return_value = [{'name': 'analyze', "id": "123", "state": "SUCCESSFUL"}]
-    get_job_datasets.return_value = [1]
-    get_dataset_dirs.return_value = ["dir1"]
-    get_job_files.return_value = ["file1"]
-    completed, pending = job.get_new_analyses()
-
-    assert len(completed) == 1
-    assert len(pending) == 0
-
-    get_new_jobs.return_value = [{'name': 'analyze', "id": "123", "state": "RUNNING"}]
-    get_job_datasets.return_value = [1]
-    get_dataset_dirs.return_value = ["dir1"]
-    get_job_files.return_value = ["file1"]
-    completed, pending = job.get_new_analyses()
-
-    assert len(completed) == 0
-    assert len(pending) == 1
+import app.collection
+import app.state
+
+def make_jobs(*created_at, state='SUCCESSFUL'):
+    return [{'id': i, 'name': f'job {i}', 'state': state, 'createdAt': t}
+            for i, t in enumerate(created_at, start=1)]
+
+@pytest.fixture
+def synced_state():
+    app.state.Dataset.create(uuid='ds', project_id=2, dir_path='dataset dir')
+    app.state.LastJobUpdate.set('2000-01-01T00:00:00.000Z')
+    yield
+    app.state.Dataset.delete().execute()
+    app.state.JobRetry.delete().execute()
+    app.state.LastJobUpdate.set('2000-01-01T00:00:00.000Z')
+
+@patch('app.smrtlink.get_job_files', return_value=['file'])
+@patch('app.smrtlink.get_job_datasets', return_value=['ds', 'unknown'])
+def test_sync_pages(get_job_datasets, get_job_files, synced_state):
+    jobs = make_jobs('2024-01-01', '2024-01-02', '2024-01-02', '2024-01-03', '2024-01-04')
+    stage = MagicMock()
+    with patch('app.smrtlink.get_jobs_created_after', return_value=jobs) as get_jobs, \
+         patch('app.JOB_SYNC_PAGE_SIZE', 2), patch('app.JOB_SYNC_MAX_PAGES', 1):
+        assert job.sync(stage) is True # jobs remain
+        get_jobs.assert_called_once_with('2000-01-01T00:00:00.000Z')
+    assert stage.call_count == 3 # the page is extended to the job created at the same time
+    [completed], pending = stage.call_args.args
+    assert completed.dir_path == 'dataset dir/Analysis 3: job 3'
+    assert completed.files == ('file',)
+    assert app.state.LastJobUpdate.time() == '2024-01-02'
+
+@patch('app.smrtlink.get_job_files', return_value=['file'])
+def test_sync_records_failed_jobs(get_job_files, synced_state):
+    jobs = make_jobs('2024-01-01', '2024-01-02')
+    def get_job_datasets(id):
+        if id == 1:
+            raise Exception('Service unavailable')
+        return ['ds']
+    stage = MagicMock()
+    with patch('app.smrtlink.get_jobs_created_after', return_value=jobs), \
+         patch('app.smrtlink.get_job_datasets', side_effect=get_job_datasets):
+        assert job.sync(stage) is False
+    stage.assert_called_once()
+    assert app.state.LastJobUpdate.time() == '2024-01-02'
+    [retry] = app.state.JobRetry.select()
+    assert retry.job_id == 1 and retry.error == 'Service unavailable'
+
+    # the failed job is retried once due, without handling the other job again
+    app.state.JobRetry.update(due=datetime.datetime.now()).execute()
+    with patch('app.smrtlink.get_jobs_created_after', return_value=[]), \
+         patch('app.smrtlink.get_jobs', return_value={1: jobs[0]}), \
+         patch('app.smrtlink.get_job_datasets', return_value=['ds']):
+        assert job.sync(stage) is False
+    assert stage.call_count == 2
+    assert app.state.JobRetry.select().count() == 0
+
+@patch('app.smrtlink.get_job_datasets', return_value=['ds'])
+def test_sync_skips_failed_and_running_jobs(get_job_datasets, synced_state):
+    stage = MagicMock()
+    jobs = make_jobs('2024-01-01', state='FAILED') + make_jobs('2024-01-02', state='RUNNING')
+    with patch('app.smrtlink.get_jobs_created_after', return_value=jobs):
+        job.sync(stage)
+    get_job_datasets.assert_called_once()
+    completed, [pending] = stage.call_args.args
+    assert completed == []
+
+@pytest.fixture
+def indexed_jobs():
+    jobs = make_jobs('2024-01-01', '2024-01-02', '2024-01-03') + make_jobs('2024-01-04', state='RUNNING')
+    jobs[3]['id'] = 4
+    app.state.DatasetJob.add_many([{'dataset_uuid': 'ds', 'job_id': job['id'], 'job_name': job['name'],
+                                    'state': job['state']} for job in jobs])
+    app.state.JobIndexUpdate.set_caught_up()
+    yield jobs
+    app.state.DatasetJob.delete().execute()
+    app.state.JobIndexUpdate.update(caught_up=False).execute()
+
+def test_get_analyses_isolates_failed_jobs(indexed_jobs):
+    dataset = MagicMock(uuid='ds', dir_path='dataset dir')
+    def get_job_files(id):
+        if id == 2:
+            raise Exception('Service unavailable')
+        return [f'file {id}']
+    with patch('app.smrtlink.get_jobs', return_value={4: indexed_jobs[3]}), \
+         patch('app.smrtlink.get_job_files', side_effect=get_job_files) as files:
+        completed, [pending] = job.get_analyses(dataset)
+    assert files.call_count == 3
+    assert [analysis.files for analysis in completed] == [('file 1',), ('file 3',)]
+    assert pending.job['id'] == 4
+
+@patch('app.smrtlink.get_job_files', return_value=['file'])
+def test_get_analyses_uses_index(get_job_files, indexed_jobs):
+    dataset = MagicMock(uuid='ds', dir_path='dataset dir')
+    finished = dict(indexed_jobs[3], state='SUCCESSFUL')
+    with patch('app.smrtlink.get_dataset_jobs') as get_dataset_jobs, \
+         patch('app.smrtlink.get_jobs', return_value={4: finished}) as get_jobs:
+        completed, pending = job.get_analyses(dataset)
+        assert len(completed) == 4 and pending == []
+        get_jobs.assert_called_once_with([4]) # only the job which was pending
+        job.get_analyses(MagicMock(uuid='no jobs', dir_path='other dir'))
+        assert get_jobs.call_count == 1
+    get_dataset_jobs.assert_not_called()
+    [row] = app.state.DatasetJob.select().where(app.state.DatasetJob.job_id == 4)
+    assert row.state == 'SUCCESSFUL'
+
+@pytest.fixture
+def incomplete_index():
+    app.state.JobIndexUpdate.update(until='2024-01-02').execute()
+    yield
+    app.state.JobIndexUpdate.update(until=app.state.FIRST_JOB_UPDATE,
+                                    timestamp=app.state.FIRST_JOB_UPDATE,
+                                    caught_up=False).execute()
+    app.state.DatasetJob.delete().execute()
+
+def test_sync_backfills_index(incomplete_index, synced_state):
+    app.state.LastJobUpdate.set('2024-01-02')
+    jobs = make_jobs('2024-01-01', '2024-01-02', '2024-01-03')
+    dataset = MagicMock(uuid='ds', dir_path='dataset dir')
+    with patch('app.smrtlink.get_dataset_jobs', return_value=[]) as get_dataset_jobs:
+        job.get_analyses(dataset) # falls back to SMRT Link while the index is incomplete
+    get_dataset_jobs.assert_called_once_with('ds')
+    with patch('app.smrtlink.get_jobs_created_after', side_effect=[jobs[2:], jobs]), \
+         patch('app.smrtlink.get_job_datasets', return_value=['other']), \
+         patch('app.smrtlink.get_job_files', return_value=['file']):
+        assert job.sync(MagicMock()) is False
+    assert app.state.JobIndexUpdate.complete()
+    assert sorted(row.job_id for row in app.state.DatasetJob.select()) == [1, 2, 3]
+
+def test_index_used_once_caught_up(synced_state):
+    dataset = MagicMock(uuid='ds', dir_path='dataset dir')
+    with patch('app.smrtlink.get_dataset_jobs', return_value=[]) as get_dataset_jobs:
+        job.get_analyses(dataset) # nothing has been synced yet
+    get_dataset_jobs.assert_called_once_with('ds')
+    jobs = make_jobs('2024-01-01', '2024-01-02')
+    jobs[0]['projectId'] = 1
+    stage = MagicMock()
+    with patch('app.smrtlink.get_jobs_created_after', return_value=jobs), \
+         patch('app.smrtlink.get_job_datasets', return_value=['ds']), \
+         patch('app.smrtlink.get_job_files', return_value=['file']):
+        assert job.sync(stage) is False
+        assert stage.call_args_list[0].args == ([], []) # the job in project 1 is not synced...
+        with patch('app.smrtlink.get_dataset_jobs') as get_dataset_jobs:
+            completed, _ = job.get_analyses(dataset) # ...but is found in the index
+    get_dataset_jobs.assert_not_called()
+    assert [analysis.dir_path for analysis in completed] == \
+           ['dataset dir/Analysis 1: job 1', 'dataset dir/Analysis 2: job 2']
+    app.state.DatasetJob.delete().execute()
+    app.state.JobIndexUpdate.update(caught_up=False).execute()
+
+@pytest.fixture
+def pending():
+    job = {'id': 7, 'name': 'mapping', 'state': 'RUNNING'}
+    with patch('app.job.POLLER'):
+        app.job.track([app.collection.PendingAnalysis('dir1', job),
+                       app.collection.PendingAnalysis('dir2', job)])
+    app.state.PendingJob.update(next_check=datetime.datetime.now()).execute() # due now
+    yield job
+    app.state.PendingJob.delete().execute()
+
+@patch('app.filesystem.stage_many')
+def test_poll_backs_off(stage_many, pending):
+    with patch('app.smrtlink.get_jobs', return_value={7: pending}) as get_jobs:
+        job.poll()
+    get_jobs.assert_called_once_with([7]) # one request for both directories
+    stage_many.assert_not_called()
+    intervals = {p.interval for p in app.state.PendingJob.select()}
+    assert intervals == {app.JOB_POLL_MIN_INTERVAL * 2}
+    with patch('app.smrtlink.get_jobs') as get_jobs:
+        job.poll() # not due yet
+    get_jobs.assert_not_called()
+
+@patch('app.filesystem.stage_many')
+@patch('app.smrtlink.get_job_files', return_value=['out.bam'])
+def test_poll_stages_completed_job(get_job_files, stage_many, pending):
+    completed = dict(pending, state='SUCCESSFUL')
+    with patch('app.smrtlink.get_jobs', return_value={7: completed}):
+        job.poll()
+    [analyses] = stage_many.call_args.args
+    assert sorted(a.dir_path for a in analyses) == ['dir1/Analysis 7: mapping', 'dir2/Analysis 7: mapping']
+    assert app.state.PendingJob.select().count() == 0
+
+@patch('app.filesystem.stage_many')
+@patch('app.smrtlink.get_job_files', return_value=['out.bam'])
+def test_poll_keeps_job_tracked_meanwhile(get_job_files, stage_many, pending):
+    completed = dict(pending, state='SUCCESSFUL')
+    def get_jobs(ids):
+        with patch('app.job.POLLER'): # tracked for another dataset while the job is checked on
+            app.job.track([app.collection.PendingAnalysis('dir3', pending)])
+        return {7: completed}
+    with patch('app.smrtlink.get_jobs', side_effect=get_jobs):
+        job.poll()
+    assert [p.dir_path for p in app.state.PendingJob.select()] == ['dir3']
+
+@patch('app.filesystem.stage_many')
+@patch('app.smrtlink.get_job_files', side_effect=Exception('Service unavailable'))
+def test_poll_backs_off_when_files_unavailable(get_job_files, stage_many, pending):
+    completed = dict(pending, state='SUCCESSFUL')
+    with patch('app.smrtlink.get_jobs', return_value={7: completed}):
+        job.poll()
+    stage_many.assert_not_called()
+    assert app.state.PendingJob.select().count() == 2 # tried again later
+    assert app.state.PendingJob.next_check_time() > datetime.datetime.now()
+
+@patch('app.filesystem.stage_many')
+def test_poll_forgets_failed_and_missing_jobs(stage_many, pending):
+    with patch('app.smrtlink.get_jobs', return_value={7: dict(pending, state='FAILED')}):
+        job.poll()
+    assert app.state.PendingJob.select().count() == 0
+    stage_many.assert_not_called()
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import app.lock
+
+def test_same_key_is_serialized():
+    lock = app.lock.KeyedLock()
+    inside = []
+    overlap = []
+    def work():
+        with lock(1):
+            inside.append(1)
+            overlap.append(len(inside))
+            time.sleep(0.01)
+            inside.pop()
+    threads = [threading.Thread(target=work) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlap == [1] * 5
+    assert len(lock) == 0 # locks are discarded once unused
+
+def test_different_keys_run_in_parallel():
+    lock = app.lock.KeyedLock()
+    barrier = threading.Barrier(2, timeout=1)
+    def work(key):
+        with lock(key):
+            barrier.wait() # raises if the other thread cannot get in
+    threads = [threading.Thread(target=work, args=(key,)) for key in (1, 2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not barrier.broken
+
+def test_reentrant_and_multiple_keys():
+    lock = app.lock.KeyedLock()
+    with lock('b', 'a', 'a'):
+        with lock('a'):
+            assert len(lock) == 2
+    assert len(lock) == 0
+
+def test_exclusive_waits_for_shared():
+    lock = app.lock.SharedLock()
+    events = []
+    shared_held = threading.Event()
+    def shared():
+        with lock.shared():
+            shared_held.set()
+            time.sleep(0.05)
+            events.append('shared done')
+    def exclusive():
+        shared_held.wait()
+        with lock.exclusive():
+            events.append('exclusive')
+    threads = [threading.Thread(target=shared), threading.Thread(target=exclusive)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert events == ['shared done', 'exclusive']
+
+def test_shared_waits_for_exclusive():
+    lock = app.lock.SharedLock()
+    barrier = threading.Barrier(2, timeout=1)
+    events = []
+    def shared():
+        barrier.wait()
+        with lock.shared():
+            events.append('shared')
+    thread = threading.Thread(target=shared)
+    thread.start()
+    with lock.exclusive():
+        barrier.wait()
+        time.sleep(0.05)
+        events.append('exclusive done')
+    thread.join()
+    assert events == ['exclusive done', 'shared']
@@ -28,22 +28,25 @@ pytestmark = pytest.mark.usefixtures("setup")
 )
 def test_invalid_requests(request_, uri, error_code):
     with patch('time.sleep'), \
-         patch('app.server.logger') as logger:
+         patch('app.logger') as logger:
         assert request_(f'http://localhost:{APP_PORT}{uri}').status_code == error_code
         assert logger.info.called
 
-@pytest.mark.parametrize("request_, uri, handler", 
+@pytest.mark.parametrize("request_, uri, kind", 
     (
-        (post, "/smrt-link/projects", 'app.handling.new_project'),
-        (put, "/smrt-link/projects/2", 'app.handling.update_project'),
-        (delete, "/smrt-link/projects/2", 'app.handling.delete_project'),
-        (post, "/smrt-link/job-manager/jobs/analysis", 'app.handling.update_analyses')
+        (post, "/smrt-link/projects", 'new_project'),
+        (put, "/smrt-link/projects/2", 'updated_project'),
+        (delete, "/smrt-link/projects/2", 'deleted_project'),
+        (post, "/smrt-link/job-manager/jobs/analysis", 'new_analyses')
     )
 )
-def test_valid_requests(request_, uri, handler):
-    with patch(handler) as handling_function, \
-         patch('time.sleep'), \
-         patch('app.server.logger') as logger:
+def test_valid_requests(request_, uri, kind):
+    with patch('app.worker.Workers.enqueue') as enqueue, \
+         patch('app.logger') as logger:
         assert request_(f'http://localhost:{APP_PORT}{uri}').status_code == 200
-        assert handling_function.called
-        assert logger.info.called
\ No newline at end of file
+        assert enqueue.call_args.args[0] == kind
+        assert logger.info.called
+
+def test_request_not_queued():
+    with patch('app.worker.Workers.enqueue', side_effect=Exception('database is locked')):
+        assert put(f'http://localhost:{APP_PORT}/smrt-link/projects/2').status_code == 500
@@ -0,0 +1,73 @@
+from unittest.mock import patch
+import app.smrtlink
+
+def test_cache_evicts_least_recently_used():
+    cache = app.smrtlink.ResponseCache(2)
+    cache.put('a', [1])
+    cache.put('b', [2])
+    assert cache.get('a') == [1] # 'b' is now the least recently used
+    cache.put('c', [3])
+    assert cache.get('b') is None
+    assert cache.get('c') == [3]
+    assert cache.stats() == {'hits': 2, 'misses': 1, 'evictions': 1, 'size': 2}
+
+def test_cache_persists(tmp_path):
+    path = str(tmp_path / 'cache.jsonl')
+    cache = app.smrtlink.ResponseCache(2, path)
+    for key in 'abc':
+        cache.put(key, [{'path': key}])
+    with open(path, 'a') as f:
+        f.write('["d", [') # cut short
+    cache = app.smrtlink.ResponseCache(2, path)
+    assert cache.get('a') is None
+    assert cache.get('c') == [{'path': 'c'}]
+    with open(path) as f:
+        assert len(f.readlines()) == 2 # rewritten without evicted entries
+
+def test_cache_file_compacted(tmp_path):
+    path = str(tmp_path / 'cache.jsonl')
+    cache = app.smrtlink.ResponseCache(2, path)
+    for key in 'abcde':
+        cache.put(key, [key])
+    with open(path) as f:
+        assert len(f.readlines()) == 2 # compacted to 'd' and 'e' when 'e' was appended
+    assert app.smrtlink.ResponseCache(2, path).get('e') == ['e']
+
+@patch('app.smrtlink.DnascSmrtLinkClient.get_authorization_token', return_value={})
+def test_client_caches_unchanging_responses(get_authorization_token):
+    client = app.smrtlink.DnascSmrtLinkClient('localhost', 8243, 'user', 'password',
+                                              cache=app.smrtlink.ResponseCache(10))
+    with patch.object(client, 'get', return_value=[{'path': 'out.bam'}]) as get:
+        for _ in range(3):
+            assert client.get_finished_job_datastore(7) == [{'path': 'out.bam'}]
+            client.get_job_datasets(7)
+        client.get_job_datastore(7) # may yet change, so not cached
+    assert get.call_count == 3
+    assert client.cache.stats()['hits'] == 4
+
+def project(id):
+    return {'id': id, 'datasets': [], 'members': [{'login': 'owner', 'role': 'OWNER'},
+                                                  {'login': f'member {id}', 'role': 'CAN_VIEW'}]}
+
+@patch('app.smrtlink.CLIENT')
+def test_get_new_projects(client):
+    projects = {id: project(id) for id in (1, 2, 5, 6, 8)} # 3, 4 and 7 were deleted
+    client.get_project_dict.side_effect = projects.get
+    new_projects = list(app.smrtlink.get_new_projects(2))
+    assert [id for id, _, _ in new_projects] == [5, 6, 8]
+    assert new_projects[0][2] == ['member 5']
+    assert client.get_project_dict.call_count == 9 # 3 to 11
+    client.get_project_ids.assert_not_called()
+
+@patch('app.smrtlink.CLIENT')
+def test_get_new_projects_gap_too_long(client):
+    projects = {id: project(id) for id in (1, 2, 6)}
+    client.get_project_dict.side_effect = projects.get
+    assert list(app.smrtlink.get_new_projects(2)) == []
+    assert client.get_project_dict.call_count == app.smrtlink.MAX_MISSING_PROJECTS
+
+@patch('app.smrtlink.CLIENT')
+def test_get_new_projects_first(client):
+    client.get_project_ids.return_value = [1, 4, 2]
+    client.get_project_dict.side_effect = {id: project(id) for id in (1, 2, 4)}.get
+    assert [id for id, _, _ in app.smrtlink.get_new_projects(None)] == [4]
@@ -0,0 +1,66 @@
+import concurrent.futures
+import http.server
+import threading
+import json
+import pytest
+import urllib3
+from unittest.mock import patch
+
+import app.smrtlink_client
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections open between requests
+
+    def do_GET(self):
+        body = json.dumps({'path': self.path}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Client(app.smrtlink_client.RESTClient):
+    def refresh(self):
+        pass
+
+@pytest.fixture(scope='module')
+def port():
+    server = http.server.ThreadingHTTPServer(('localhost', 0), KeepAliveHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server_thread.join()
+
+def test_connection_reuse(port):
+    client = Client('localhost', port)
+    for i in range(5):
+        assert client.get(f'/resource/{i}') == {'path': f'/resource/{i}'}
+    stats = client.connection_stats()
+    assert stats['requests'] == 5
+    assert stats['connections'] == 1
+    assert stats['reused'] == 4
+    client.close()
+
+def test_pool_size_bounds_connections(port):
+    client = Client('localhost', port, pool_size=2)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda i: client.get(f'/resource/{i}'), range(40)))
+    assert len(results) == 40
+    stats = client.connection_stats()
+    assert stats['requests'] == 40
+    assert stats['connections'] <= 2
+    client.close()
+
+@pytest.mark.parametrize('retries', [0, 2])
+def test_connection_error_is_retried(retries):
+    client = Client('localhost', 1, retries=retries, backoff_factor=0, timeout=1)
+    make_request = urllib3.connectionpool.HTTPConnectionPool._make_request
+    with patch.object(urllib3.connectionpool.HTTPConnectionPool, '_make_request',
+                      autospec=True, side_effect=make_request) as attempt, \
+         pytest.raises(app.smrtlink_client.requests.exceptions.ConnectionError):
+        client.get('/resource')
+    assert attempt.call_count == retries + 1
@@ -1,4 +1,10 @@
+import concurrent.futures
+import threading
+import sqlite3
 import datetime
+from unittest.mock import patch
+import peewee
+import pytest
 
 import app.state
 import app
@@ -35,4 +41,149 @@ def test_dataset_update_project_id():
                                                           dir_path='whatever')
     assert dataset.project_id == 1
     dataset.update_project_id(2)
-    assert dataset.project_id == 2
\ No newline at end of file
+    assert dataset.project_id == 2
+
+def test_event_claim_order():
+    app.state.Event.add('updated_project', 3, delay=60)
+    app.state.Event.add('deleted_project', 2)
+    app.state.Event.add('new_project')
+    event = app.state.Event.claim()
+    assert event.kind == 'deleted_project' and event.project_id == 2
+    assert app.state.Event.claim().kind == 'new_project'
+    assert app.state.Event.claim() is None # updated_project is not yet due
+    event.done()
+    assert app.state.Event.select().count() == 2
+    app.state.Event.delete().execute()
+
+def test_event_release_claimed():
+    app.state.Event.add('new_analyses')
+    assert app.state.Event.claim() is not None
+    assert app.state.Event.claim() is None
+    app.state.Event.release_claimed()
+    assert app.state.Event.claim().kind == 'new_analyses'
+    app.state.Event.delete().execute()
+
+def test_event_coalesce():
+    for _ in range(5):
+        app.state.Event.add('updated_project', 2, coalesce=True)
+    assert app.state.Event.select().count() == 1
+    running = app.state.Event.claim()
+    for _ in range(5): # notifications received while project 2 is being handled
+        app.state.Event.add('updated_project', 2, coalesce=True)
+    assert app.state.Event.select().count() == 2
+    assert app.state.Event.claim() is None # wait for the running event
+    running.done()
+    assert app.state.Event.claim().project_id == 2
+    app.state.Event.delete().execute()
+
+def test_event_other_projects_not_blocked():
+    app.state.Event.add('updated_project', 2)
+    app.state.Event.add('updated_project', 2)
+    app.state.Event.add('updated_project', 3)
+    assert app.state.Event.claim().project_id == 2
+    assert app.state.Event.claim().project_id == 3
+    assert app.state.Event.claim() is None
+    app.state.Event.delete().execute()
+
+def test_permission_get_renewable():
+    now = datetime.datetime.now()
+    app.state.Dataset.create(uuid='renew', project_id=5, dir_path='whatever')
+    app.state.ProjectMember.insert(project_id=5, member_id='member').execute()
+    for id, member_id, days in (('soon', 'member', 1),
+                                ('later', 'member', 30),
+                                ('expired', 'member', -1),
+                                ('former', 'former member', 1)):
+        app.state.Permission.insert(id=id,
+                                    member_id=member_id,
+                                    dataset_uuid='renew',
+                                    expiry=now + datetime.timedelta(days=days)).execute()
+    renewable = app.state.Permission.get_renewable(now + datetime.timedelta(days=7))
+    assert [p.id for p in renewable] == ['soon']
+    app.state.Permission.delete().execute()
+    app.state.ProjectMember.delete().execute()
+
+def test_dataset_bulk_updates():
+    with app.state.db.atomic() as transaction:
+        app.state.Dataset.add_many([{'uuid': f'bulk-{i}', 'project_id': 1, 'dir_path': f'dir {i}'}
+                                    for i in range(1200)])
+        datasets = app.state.Dataset.get_by_uuids([f'bulk-{i}' for i in range(0, 1200, 2)] + ['missing'])
+        assert len(datasets) == 600
+        assert datasets['bulk-4'].dir_path == 'dir 4'
+        app.state.Dataset.update_project_ids({'bulk-1': 2, 'bulk-2': 3})
+        app.state.Dataset.update_dir_paths({'bulk-1': 'moved'})
+        datasets = app.state.Dataset.get_by_uuids(['bulk-0', 'bulk-1', 'bulk-2'])
+        assert [datasets[f'bulk-{i}'].project_id for i in range(3)] == [1, 2, 3]
+        assert [datasets[f'bulk-{i}'].dir_path for i in range(3)] == ['dir 0', 'moved', 'dir 2']
+        transaction.rollback()
+
+def test_project_member_bulk():
+    with app.state.db.atomic() as transaction:
+        app.state.ProjectMember.add_many(7, ['a', 'b'])
+        app.state.ProjectMember.add_many(8, ['c'])
+        assert app.state.ProjectMember.get_member_ids(7) == {'a', 'b'}
+        transaction.rollback()
+
+def test_permission_get_by_many_members():
+    with app.state.db.atomic() as transaction:
+        app.state.Permission.insert_many([{'id': f'{member}:{i}', 'member_id': member, 'dataset_uuid': f'uuid-{i}',
+                                           'expiry': datetime.datetime(2100, 1, 1)}
+                                          for member in ('a', 'b', 'c') for i in range(700)]).execute()
+        members = ['a', 'c'] + [f'other-{i}' for i in range(400)]
+        permissions = app.state.Permission.get_by_members(members, [f'uuid-{i}' for i in range(0, 700, 2)] + ['missing'])
+        assert len(permissions) == 700
+        assert {p.member_id for p in permissions} == {'a', 'c'}
+        transaction.rollback()
+
+def test_migrate_old_database(tmp_path):
+    path = str(tmp_path / 'old.db')
+    old = sqlite3.connect(path)
+    old.executescript('''
+        CREATE TABLE projectmember (id INTEGER PRIMARY KEY, project_id INTEGER NOT NULL, member_id VARCHAR(255) NOT NULL);
+        INSERT INTO projectmember (project_id, member_id) VALUES (1, 'a'), (1, 'a'), (1, 'b');
+        CREATE TABLE lastjobupdate (id INTEGER PRIMARY KEY, timestamp DATETIME NOT NULL);
+        INSERT INTO lastjobupdate (timestamp) VALUES ('2001-01-01'), ('2000-01-01');
+    ''')
+    old.close()
+    db = peewee.SqliteDatabase(path, pragmas=app.state.PRAGMAS)
+    with patch('app.state.db', db), db.bind_ctx(app.state.models):
+        app.state.migrate()
+        assert app.state.ProjectMember.select().count() == 2
+        assert app.state.LastJobUpdate.select().count() == 1
+        assert db.pragma('user_version') == len(app.state.MIGRATIONS)
+        assert db.pragma('journal_mode') == 'wal'
+        index_update = app.state.JobIndexUpdate.current() # jobs synced so far are indexed separately
+        assert (index_update.timestamp, index_update.until) == (app.state.FIRST_JOB_UPDATE, '2001-01-01')
+        assert not app.state.JobIndexUpdate.complete()
+        with pytest.raises(peewee.IntegrityError):
+            app.state.ProjectMember.add_many(1, ['b'])
+        app.state.migrate() # nothing left to do
+        assert app.state.ProjectMember.get_member_ids(1) == {'a', 'b'}
+    db.close()
+
+def test_threads_share_memory_database():
+    def add():
+        with app.state.connection():
+            app.state.Event.add('new_project')
+    thread = threading.Thread(target=add)
+    thread.start()
+    thread.join()
+    assert app.state.Event.select().count() == 1
+    app.state.Event.delete().execute()
+
+def test_concurrent_writes(tmp_path):
+    db = peewee.SqliteDatabase(str(tmp_path / 'state.db'), pragmas=app.state.PRAGMAS, timeout=30)
+    def work(i):
+        with app.state.connection():
+            for _ in range(20):
+                app.state.Event.add('updated_project', i, coalesce=True)
+                event = app.state.Event.claim()
+                if event is not None:
+                    event.done()
+    with patch('app.state.db', db), db.bind_ctx(app.state.models):
+        app.state.migrate()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(work, range(8))) # raises if any write failed
+        events = list(app.state.Event.select())
+        assert not any(event.claimed for event in events)
+        assert len({event.project_id for event in events}) == len(events) # coalesced
+    db.close()
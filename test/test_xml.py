@@ -0,0 +1,113 @@
+import os
+from unittest.mock import patch
+import pytest
+
+import test.data
+import app.xml
+import app
+
+def info(name):
+    return app.xml.DatasetInfo(uuid=name, name=name, movie_id=None, sample_name=None,
+                               well_sample_name=None, barcode=None, files=(),
+                               supplemental_files=(), child_paths=())
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    app.xml.cache_clear()
+    yield
+    app.xml.cache_clear()
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    return str(path)
+
+def test_load_is_cached(tmp_path):
+    path = write(tmp_path / 'a.xml', '<a/>')
+    with patch('app.xml._parse', side_effect=lambda p: info(p)) as parse:
+        first = app.xml.load(path)
+        assert app.xml.load(path) is first
+        assert parse.call_count == 1
+    assert app.xml.cache_info()['hits'] == 1
+    assert app.xml.cache_info()['misses'] == 1
+
+def test_modified_file_is_parsed_again(tmp_path):
+    path = write(tmp_path / 'a.xml', '<a/>')
+    with patch('app.xml._parse', side_effect=lambda p: info(p)) as parse:
+        app.xml.load(path)
+        write(path, '<a></a>') # size changes even if mtime does not
+        app.xml.load(path)
+        assert parse.call_count == 2
+
+def test_cache_is_bounded(tmp_path):
+    paths = [write(tmp_path / f'{i}.xml', '<a/>') for i in range(3)]
+    with patch('app.xml._parse', side_effect=lambda p: info(p)) as parse, \
+         patch('app.XML_CACHE_SIZE', 2):
+        for path in paths:
+            app.xml.load(path)
+        assert app.xml.cache_info()['size'] == 2
+        app.xml.load(paths[2]) # most recently used is kept
+        assert parse.call_count == 3
+        app.xml.load(paths[0]) # least recently used was evicted
+        assert parse.call_count == 4
+
+def test_parse_error_is_not_cached(tmp_path):
+    path = write(tmp_path / 'a.xml', '<a/>')
+    with patch('app.xml._parse', side_effect=ValueError('bad')):
+        with pytest.raises(ValueError):
+            app.xml.load(path)
+    assert app.xml.cache_info()['size'] == 0
+
+TOMATOES = 'test/tomatoes/pb_formats'
+DATASET_XML_FILES = sorted(os.path.join(TOMATOES, name) for name in os.listdir(TOMATOES)
+                           if name.endswith('.xml'))
+
+def test_stream_parent():
+    info = app.xml._parse_stream(test.data.PARENT_XML)
+    assert info.uuid == '48a71a3e-c97c-43ea-ba41-8c2b31dd32b2'
+    assert info.movie_id == 'm84100_240301_194028_s1'
+    assert info.well_sample_name == 'Germany tomato 20 and 21'
+    assert [os.path.basename(p) for p in info.child_paths] == [
+        'm84100_240301_194028_s1.hifi_reads.bc1047.consensusreadset.xml',
+        'm84100_240301_194028_s1.hifi_reads.bc1048.consensusreadset.xml',
+    ]
+    assert all(os.path.isfile(p) for p in info.child_paths)
+    assert os.path.abspath('test/tomatoes/metadata/m84100_240301_194028_s1.barcodes.fasta') \
+        in info.supplemental_files
+
+def test_stream_child():
+    info = app.xml._parse_stream(test.data.CHILD_XML_1)
+    assert info.sample_name == 'Tomato 20'
+    assert info.barcode == 'bc1047--bc1047'
+    assert info.child_paths == ()
+    assert [os.path.basename(p) for p in info.files] == [
+        'm84100_240301_194028_s1.hifi_reads.bc1047.bam',
+        'm84100_240301_194028_s1.hifi_reads.bc1047.bam.pbi',
+    ]
+
+def test_stream_rejects_other_xml(tmp_path):
+    path = write(tmp_path / 'a.xml', '<a/>')
+    with pytest.raises(ValueError):
+        app.xml._parse_stream(path)
+
+@pytest.mark.parametrize('path', DATASET_XML_FILES)
+def test_stream_matches_pbcore(path):
+    pytest.importorskip('pbcore')
+    assert app.xml._parse_stream(path) == app.xml._parse_pbcore(path)
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_load_many(tmp_path, workers):
+    paths = [test.data.CHILD_XML_1, str(tmp_path / 'missing.xml'),
+             write(tmp_path / 'other.xml', '<a/>'), test.data.CHILD_XML_2]
+    with patch('app.CHILD_PARSE_WORKERS', workers), \
+         patch('app.xml.PARALLEL_PARSE_THRESHOLD', 1), \
+         patch('app.logger.warning') as warning:
+        results = app.xml.load_many(paths)
+    warning.assert_not_called() # the files were not parsed one at a time for want of processes
+    assert [r.sample_name for r in (results[0], results[3])] == ['Tomato 20', 'Tomato 21']
+    assert isinstance(results[1], FileNotFoundError)
+    assert isinstance(results[2], ValueError)
+    assert app.xml.cache_info()['size'] == 2
+    with patch('app.xml._parse') as parse:
+        assert app.xml.load_many([paths[3], paths[0]]) == [results[3], results[0]]
+        parse.assert_not_called()